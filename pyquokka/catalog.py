@@ -1,11 +1,11 @@
 import pyarrow
-import duckdb
 import ray
 import sqlglot
 import os
 import polars
 from pyarrow.fs import S3FileSystem
 from pyquokka.sql_utils import filters_to_expression
+from pyquokka.executors import get_duck_cursor
 import pyarrow.parquet as pq
 import boto3
 
@@ -15,7 +15,7 @@ class Catalog:
         self.table_id = 0
         self.samples = {}
         self.ratio = {}
-        self.con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+        self.con = get_duck_cursor()
     
     def register_table_data_and_return_ticket(self, sample, ratio):
         assert type(sample) == pyarrow.Table
@@ -90,7 +90,7 @@ class Catalog:
             count = len(sample)
         else:
             sql_statement = "select count(*) from sample where " + predicate.sql(dialect = "duckdb")
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+            con = get_duck_cursor()
             count = con.execute(sql_statement).fetchall()[0][0]
         
         estimated_cardinality = count * self.ratio[table_id]
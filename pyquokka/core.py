@@ -13,7 +13,7 @@ import boto3
 import types
 from functools import partial
 import concurrent.futures
-import duckdb
+from pyquokka.executors import get_duck_cursor
 import gc
 
 MAX_SEQ = 1000000000
@@ -155,7 +155,7 @@ class TaskManager:
             # x could be either a pyarrow table of a polars dataframe
             # print(predicate_fn)
             if type(predicate_fn) == str:
-                con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+                con = get_duck_cursor()
                 batch_arrow = x.to_arrow() if type(x) == polars.internals.DataFrame else x
                 x = polars.from_arrow(con.execute(predicate_fn).arrow())
             else:
@@ -466,9 +466,11 @@ class ExecTaskManager(TaskManager):
                 else:
                     transform_fn, dataset, dataset_id = self.blocking_nodes[actor_id]
                     if transform_fn is not None:
-                        data = transform_fn(data)
+                        data = transform_fn(data if type(data) == polars.internals.DataFrame else polars.from_arrow(data, rechunk = False))
                     if data is not None:
-                        ray.get(dataset.added_object.remote(dataset_id, ray._private.services.get_node_ip_address(), [ray.put(data.to_arrow(), _owner = dataset), len(data)]))
+                        # generators (e.g. the sort merge) can hand over arrow tables directly, those go into the object store as is
+                        data_arrow = data if type(data) == pyarrow.Table else data.to_arrow()
+                        ray.get(dataset.added_object.remote(dataset_id, ray._private.services.get_node_ip_address(), [ray.put(data_arrow, _owner = dataset), len(data)]))
                 self.output_commit(transaction, actor_id, channel_id, out_seq, state_seq)
 
                 out_seq += 1
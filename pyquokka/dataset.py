@@ -4,8 +4,9 @@ import pyarrow.parquet as pq
 import pyarrow.dataset as ds
 import json
 import pyarrow.json as pajson
-from io import BytesIO
 import boto3
+import botocore.config
+import threading
 import os
 import redis
 from collections import deque
@@ -23,6 +24,41 @@ import ray
 import math
 import asyncio
 
+# bytes.find/rfind on a single byte already go through memchr/memrchr, so the only waste was re-encoding the literal on every call
+NEWLINE = b'\n'
+
+# one S3 client per process shared by every dataset and thread, boto3 clients are thread safe once created.
+# a bigger connection pool and adaptive retries keep throughput up when many channels hit S3 at once.
+S3_CONFIG = botocore.config.Config(max_pool_connections = 64, retries = {'max_attempts': 10, 'mode': 'adaptive'})
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3', config = S3_CONFIG)
+    return _s3_client
+
+# reads the column names out of a CSV header line with arrow, which takes care of quoting and the delimiter.
+# the line comes without its newline, and arrow can't tell the columns of a block that has no line end
+def parse_csv_header(header_line, sep):
+    return csv.read_csv(pa.BufferReader(pa.py_buffer(bytes(header_line) + NEWLINE)), parse_options=csv.ParseOptions(delimiter=sep)).schema.names
+
+# arrow only infers ISO 8601 dates and timestamps. this picks up the other layouts polars' try_parse_dates did:
+# a string column becomes a Date, or failing that a Datetime, if every value parses with the inferred format
+def parse_csv_dates(df):
+    for name, dtype in zip(df.columns, df.dtypes):
+        if dtype != polars.Utf8:
+            continue
+        for target in (polars.Date, polars.Datetime):
+            try:
+                df = df.with_columns(df[name].str.strptime(target))
+                break
+            except Exception:
+                pass
+    return df
+
 # computes the overlap of two intervals (a1, a2) and (b1, b2)
 def overlap(a, b):
     return max(-1, min(a[1], b[1]) - max(a[0], b[0]))
@@ -498,7 +534,9 @@ class InputParquetDataset:
     def execute(self, mapper_id, filename = None):
         
         dataset = ds.dataset(filename)
-        return None, dataset.to_table(filter= self.filters,columns=self.columns )
+        # pre_buffer coalesces the column chunk reads into large ranges so decoding can proceed in parallel
+        return None, dataset.to_table(filter= self.filters,columns=self.columns, use_threads = True,
+            fragment_scan_options = ds.ParquetFragmentScanOptions(pre_buffer = True))
 
 # this works for a directoy of objects.
 class InputS3FilesDataset:
@@ -512,7 +550,7 @@ class InputS3FilesDataset:
 
     def get_own_state(self, num_channels):
         self.num_channels = num_channels
-        s3 = boto3.client('s3')
+        s3 = get_s3_client()
         if self.prefix is not None:
             z = s3.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix)
             self.files = [i['Key'] for i in z['Contents']]
@@ -532,14 +570,29 @@ class InputS3FilesDataset:
             curr_pos = mapper_id
         else:
             curr_pos = pos
-        s3 = boto3.client('s3')
-        while curr_pos < len(self.files):
-            #print("input batch", (curr_pos - mapper_id) / self.num_channels)
-            # since these are arbitrary byte files (most likely some image format), it is probably useful to keep the filename around or you can't tell these things apart
-            a = pa.Table.from_pydict({"filename" : [self.files[curr_pos]], "object": [s3.get_object(Bucket=self.bucket, Key=self.files[curr_pos])['Body'].read()]})
-            #print("ending reading ",time.time())
-            curr_pos += self.num_channels
-            yield curr_pos, a
+        s3 = get_s3_client()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        def download(file):
+            return s3.get_object(Bucket=self.bucket, Key=file)['Body'].read()
+
+        # double buffer: the next object is downloaded while the current one is being consumed downstream
+        # the generator can be closed early (a limit upstream, the task being stopped), so the pool and the read still in
+        # flight are dropped in the finally rather than only after the last file
+        try:
+            future = executor.submit(download, self.files[curr_pos]) if curr_pos < len(self.files) else None
+            while curr_pos < len(self.files):
+                #print("input batch", (curr_pos - mapper_id) / self.num_channels)
+                body = future.result()
+                next_pos = curr_pos + self.num_channels
+                if next_pos < len(self.files):
+                    future = executor.submit(download, self.files[next_pos])
+                # since these are arbitrary byte files (most likely some image format), it is probably useful to keep the filename around or you can't tell these things apart
+                a = pa.Table.from_pydict({"filename" : [self.files[curr_pos]], "object": [body]})
+                curr_pos = next_pos
+                yield curr_pos, a
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 # this works for a directoy of objects on disk.
 # Could have combined this with the S3FilesDataset but the code is so different might as well
@@ -608,18 +661,27 @@ class InputDiskCSVDataset:
         # if there is a header row then we need to read the first line to get the column names
         # if the user supplied column names, we should check that they match
         if self.header:
-            resp = open(files[0],"r").read(self.window)
-            first_newline = resp.find("\n")
+            with open(files[0], "rb") as f:
+                resp = f.read(self.window)
+            first_newline = resp.find(NEWLINE)
             if first_newline == -1:
                 raise Exception("could not detect the first line break. try setting the window argument to a large number")
             if self.names is None:
-                self.names = resp[:first_newline].split(self.sep)
+                self.names = parse_csv_header(resp[:first_newline], self.sep)
             else:
-                detected_names = resp[:first_newline].split(self.sep)
+                detected_names = parse_csv_header(resp[:first_newline], self.sep)
                 if self.names != detected_names:
                     print("Warning, detected column names from header row not the same as supplied column names! This could also be because your rows end with the delimiter.")
                     print("Detected", detected_names)
                     print("Supplied", self.names)
+
+        # the column names are final now, build the arrow options once instead of on every read
+        self.read_options = csv.ReadOptions(column_names=self.names, use_threads=True)
+        self.parse_options = csv.ParseOptions(delimiter=self.sep)
+        # the first partition of a file with a header skips it inside the parser instead of slicing the buffer
+        self.header_read_options = csv.ReadOptions(column_names=self.names, skip_rows=1, use_threads=True)
+        # only materialize the projected columns, the rest are tokenized but never converted
+        self.convert_options = csv.ConvertOptions(include_columns=self.columns) if self.columns is not None else csv.ConvertOptions()
         
         # if the sort info is not None, we should reorder the files based on the sort key
         if self.sort_key is not None:
@@ -629,19 +691,19 @@ class InputDiskCSVDataset:
                 # then we can sort the files based on the min and max of the sort key
                 resp = open(file, "rb").read(self.window)
                 if self.header:
-                    first_newline = resp.find(bytes('\n','utf-8'))
+                    first_newline = resp.find(NEWLINE)
                     resp = resp[first_newline + 1:]
-                first_newline = resp.find(bytes('\n','utf-8'))
+                first_newline = resp.find(NEWLINE)
                 resp = resp[:first_newline]
-                min_key = csv.read_csv(BytesIO(resp), read_options=csv.ReadOptions(
-                    column_names=self.names), parse_options=csv.ParseOptions(delimiter=self.sep))[self.sort_key][0].as_py()
+                min_key = csv.read_csv(pa.BufferReader(pa.py_buffer(resp)), read_options=self.read_options,
+                    parse_options=self.parse_options)[self.sort_key][0].as_py()
                 f = open(file, "rb")
                 f.seek(size - self.window)
                 resp = f.read(self.window)
-                first_newline = resp.find(bytes('\n','utf-8'))
+                first_newline = resp.find(NEWLINE)
                 resp = resp[first_newline + 1:]
-                max_key = csv.read_csv(BytesIO(resp), read_options=csv.ReadOptions(
-                    column_names=self.names), parse_options=csv.ParseOptions(delimiter=self.sep))[self.sort_key][-1].as_py()
+                max_key = csv.read_csv(pa.BufferReader(pa.py_buffer(resp)), read_options=self.read_options,
+                    parse_options=self.parse_options)[self.sort_key][-1].as_py()
                 file_stats.append((file, min_key, max_key, size))
             
             file_stats = sorted(file_stats, key=lambda x: x[1])
@@ -676,7 +738,7 @@ class InputDiskCSVDataset:
                 f = open(curr_file, 'rb')
                 f.seek(start_byte - self.window)
                 window = f.read(self.window)
-                pos = window.rfind(b'\n')
+                pos = window.rfind(NEWLINE)
                 prefix = window[pos + 1:]
                 partitions[partition] = (curr_file, start_byte, prefix, size_per_partition)
 
@@ -708,34 +770,33 @@ class InputDiskCSVDataset:
         file, start_byte, prefix, size_per_partition = state
         end = self.file_sizes[file]
 
-        f = open(file, "rb")   
         assert start_byte < end
-        f.seek(start_byte)         
-
         bytes_to_read = min(min(start_byte + self.stride, end) - start_byte, size_per_partition)
-        resp = f.read(bytes_to_read)
+
+        # positional read: one syscall, no shared file offset, and the descriptor does not leak
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            resp = os.pread(fd, bytes_to_read, start_byte)
+        finally:
+            os.close(fd)
         
         #print(pos, bytes_to_read)
         
-        last_newline = resp.rfind(bytes('\n', 'utf-8'))
+        last_newline = resp.rfind(NEWLINE)
         
 
         if last_newline == -1:
             raise Exception
         else:
-            resp = prefix + resp[: last_newline]
+            # stitch the carried-over prefix onto the partition with a single copy
+            resp = b''.join([prefix, memoryview(resp)[: last_newline]])
 
-            if self.header and start_byte == 0:
-                first_newline = resp.find(bytes('\n','utf-8'))
-                if first_newline == -1:
-                    raise Exception
-                resp = resp[first_newline + 1:]
+            read_options = self.header_read_options if self.header and start_byte == 0 else self.read_options
 
-            # bump = csv.read_csv(BytesIO(resp), read_options=csv.ReadOptions(
-            #     column_names=self.names), parse_options=csv.ParseOptions(delimiter=self.sep))
-            bump = polars.read_csv(resp, new_columns = self.names, sep = self.sep, has_header = False, try_parse_dates=True)
-            
-            bump = bump.select(self.columns) if self.columns is not None else bump
+            # arrow's multithreaded tokenizer does the parsing and column projection natively
+            bump = csv.read_csv(pa.BufferReader(pa.py_buffer(resp)), read_options=read_options,
+                parse_options=self.parse_options, convert_options=self.convert_options)
+            bump = parse_csv_dates(polars.from_arrow(bump))
 
             return None, bump
 
@@ -759,6 +820,7 @@ class InputDiskJSONDataset:
             self.parse_options = pajson.ParseOptions(pajson.ParseOptions(explicit_schema = schema, newlines_in_values = False))
         else:
             self.parse_options = pajson.ParseOptions(pajson.ParseOptions(newlines_in_values = False))
+        self.read_options = pajson.ReadOptions(use_threads=True)
 
 
         if sort_info is not None:
@@ -791,18 +853,16 @@ class InputDiskJSONDataset:
                 # Get min key
                 resp = open(file, "rb").read(self.window)
 
-                first_newline = resp.find(bytes('\n','utf-8'))
+                first_newline = resp.find(NEWLINE)
                 resp = resp[:first_newline]
-                min_key = pajson.read_json(BytesIO(resp), read_options=pajson.ReadOptions(
-                    use_threads=True), parse_options=self.parse_options)[self.sort_key][0].as_py()
+                min_key = pajson.read_json(pa.BufferReader(pa.py_buffer(resp)), read_options=self.read_options, parse_options=self.parse_options)[self.sort_key][0].as_py()
                 
                 f = open(file, "rb")
                 f.seek(size - self.window)
                 resp = f.read(self.window)
-                first_newline = resp.find(bytes('\n','utf-8'))
+                first_newline = resp.find(NEWLINE)
                 resp = resp[first_newline + 1:]
-                max_key = pajson.read_json(BytesIO(resp), read_options=pajson.ReadOptions(
-                    use_threads=True), parse_options=self.parse_options)[self.sort_key][-1].as_py()
+                max_key = pajson.read_json(pa.BufferReader(pa.py_buffer(resp)), read_options=self.read_options, parse_options=self.parse_options)[self.sort_key][-1].as_py()
                 file_stats.append((file, min_key, max_key, size))
             
             file_stats = sorted(file_stats, key=lambda x: x[1])
@@ -835,7 +895,7 @@ class InputDiskJSONDataset:
                 f = open(curr_file, 'rb')
                 f.seek(start_byte - self.window)
                 window = f.read(self.window)
-                pos = window.rfind(b'\n')
+                pos = window.rfind(NEWLINE)
                 prefix = window[pos + 1:]
                 partitions[partition] = (curr_file, start_byte, prefix, size_per_partition)
         
@@ -868,14 +928,17 @@ class InputDiskJSONDataset:
         file, start_byte, prefix, size_per_partition = state
         end = self.file_sizes[file]
 
-        f = open(file, "rb")   
         assert start_byte < end
-        f.seek(start_byte)         
-
         bytes_to_read = min(min(start_byte + self.stride, end) - start_byte, size_per_partition)
-        resp = f.read(bytes_to_read)
+
+        # positional read: one syscall, no shared file offset, and the descriptor does not leak
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            resp = os.pread(fd, bytes_to_read, start_byte)
+        finally:
+            os.close(fd)
         
-        last_newline = resp.rfind(bytes('\n', 'utf-8'))
+        last_newline = resp.rfind(NEWLINE)
         
 
         if last_newline == -1:
@@ -883,8 +946,7 @@ class InputDiskJSONDataset:
         else:
             resp = prefix + resp[: last_newline]
 
-            bump = pajson.read_pajson(BytesIO(resp), read_options=pajson.ReadOptions(
-                    use_threads=True), parse_options=self.parse_options)
+            bump = pajson.read_json(pa.BufferReader(pa.py_buffer(resp)), read_options=self.read_options, parse_options=self.parse_options)
             bump = bump.select(self.keys) if self.keys is not None else bump
 
             return None, bump
@@ -912,7 +974,7 @@ class FakeFile:
                 #print(self.prefix)
                 #print(buf[:100])
                 if self.skip_header:
-                    first_linebreak = buf.find(b'\n')
+                    first_linebreak = buf.find(NEWLINE)
                     buf = buf[first_linebreak + 1:]
                 return buf
             else:
@@ -977,7 +1039,7 @@ class InputS3CSVDataset:
         # print("intializing CSV reading strategy. This is currently done locally, which might take a while.")
         self.num_channels = num_channels
 
-        s3 = boto3.client('s3')  # needs boto3 client, however it is transient and is not part of own state, so Ray can send this thing! 
+        s3 = get_s3_client()  # needs boto3 client, however it is transient and is not part of own state, so Ray can send this thing! 
         if self.key is not None:
             files = [self.key]
             response = s3.head_object(Bucket=self.bucket, Key=self.key)
@@ -1003,18 +1065,22 @@ class InputS3CSVDataset:
         if self.header:
             resp = s3.get_object(
                 Bucket=self.bucket, Key=files[0], Range='bytes={}-{}'.format(0, self.window))['Body'].read()
-            first_newline = resp.find(bytes('\n', 'utf-8'))
+            first_newline = resp.find(NEWLINE)
             if first_newline == -1:
                 raise Exception("could not detect the first line break. try setting the window argument to a large number")
             if self.names is None:
-                self.names = resp[:first_newline].decode("utf-8").split(",")
+                self.names = parse_csv_header(resp[:first_newline], self.sep)
             else:
-                detected_names = resp[:first_newline].decode("utf-8").split(",")
+                detected_names = parse_csv_header(resp[:first_newline], self.sep)
                 if self.names != detected_names:
                     print("Warning, detected column names from header row not the same as supplied column names! This could also be because your rows end with the delimiter.")
                     print("Detected", detected_names)
                     print("Supplied", self.names)
 
+        # the column names are final now, build the arrow options once instead of on every read
+        self.read_options = csv.ReadOptions(column_names=self.names, use_threads=True)
+        self.parse_options = csv.ParseOptions(delimiter=self.sep)
+
          # if the sort info is not None, we should reorder the files based on the sort key
         if self.sort_key is not None:
             raise NotImplementedError
@@ -1037,11 +1103,10 @@ class InputS3CSVDataset:
         @ray.remote
         def download_ranges(inputs):
             executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
-            boto3.client('s3')
+            s3 = get_s3_client()
             def download_range(bucket, file, start_byte, end_byte):
-                s3 = boto3.client('s3')
                 resp = s3.get_object(Bucket=bucket, Key=file, Range='bytes={}-{}'.format(start_byte, end_byte))['Body'].read()
-                last_newline = resp.rfind(b'\n')
+                last_newline = resp.rfind(NEWLINE)
                 return resp[last_newline + 1:]
             futures = {}
             for partition in inputs:
@@ -1100,7 +1165,7 @@ class InputS3CSVDataset:
     def execute(self, mapper_id, state = None):
 
         if self.s3 is None:
-            self.s3 = boto3.client("s3")
+            self.s3 = get_s3_client()
             self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
 
         assert self.file_sizes is not None
@@ -1137,12 +1202,12 @@ class InputS3CSVDataset:
         if last_file == -1:
             raise Exception("something is wrong, try changing the stride")
 
-        last_newline = results[last_file].rfind(bytes('\n', 'utf-8'))
+        last_newline = results[last_file].rfind(NEWLINE)
 
         skip_header = self.header and pos == 0
 
         fake_file = FakeFile(results, last_newline, prefix, last_file, skip_header)
-        bump = csv.read_csv(fake_file, read_options=csv.ReadOptions(column_names=self.names), parse_options=csv.ParseOptions(delimiter=self.sep))
+        bump = csv.read_csv(fake_file, read_options=self.read_options, parse_options=self.parse_options)
         # bump = polars.read_csv(fake_file, columns = self.names, sep = self.sep)
         del fake_file
 
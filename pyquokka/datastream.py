@@ -375,14 +375,14 @@ class DataStream:
         
         if self.materialized:
             batch_arrow = self._get_materialized_df().to_arrow()
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+            con = get_duck_cursor()
             df = polars.from_arrow(con.execute("select * from batch_arrow where " + predicate.sql(dialect = "duckdb")).arrow())
             return self.quokka_context.from_polars(df)
 
         if not optimizer.normalize.normalized(predicate):
             def f(df):
                 batch_arrow = df.to_arrow()
-                con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+                con = get_duck_cursor()
                 return polars.from_arrow(con.execute("select * from batch_arrow where " + predicate.sql(dialect = "duckdb")).arrow())
         
             transformed = self.transform(f, new_schema = self.schema, required_columns=self.schema)
@@ -695,7 +695,7 @@ class DataStream:
         
         if self.materialized:
             batch_arrow = self._get_materialized_df().to_arrow()
-            con = duckdb.connect().execute('PRAGMA threads=%d' % multiprocessing.cpu_count())
+            con = get_duck_cursor()
             df = polars.from_arrow(con.execute(enhanced_exp).arrow())
             return self.quokka_context.from_polars(df)
 
@@ -704,7 +704,7 @@ class DataStream:
             for i, (col_name, type_) in enumerate(zip(batch_arrow.schema.names, batch_arrow.schema.types)):
                 if pa.types.is_boolean(type_):
                     batch_arrow = batch_arrow.set_column(i, col_name, compute.cast(batch_arrow.column(col_name), pa.int32()))
-            con = duckdb.connect().execute('PRAGMA threads=%d' % multiprocessing.cpu_count())
+            con = get_duck_cursor()
             return polars.from_arrow(con.execute(func).arrow())
         
         return self.quokka_context.new_stream(
@@ -1024,7 +1024,7 @@ class DataStream:
             required_columns = required_columns.union(required_columns_from_exp(node.this))
 
         def polars_func(batch):
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+            con = get_duck_cursor()
             batch_arrow = batch.to_arrow()
             return polars.from_arrow(con.execute(sql_statement).arrow())
 
@@ -1123,7 +1123,7 @@ class DataStream:
         
         def polars_func(batch):
 
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+            con = get_duck_cursor()
             if sql_statement != "select *": # if there are any columns to add
                 batch_arrow = batch.to_arrow()
                 batch = polars.from_arrow(con.execute(sql_statement + " from batch_arrow").arrow())
@@ -1584,7 +1584,7 @@ class DataStream:
 
         def f(df):
             batch_arrow = df.to_arrow()
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
+            con = get_duck_cursor()
             return polars.from_arrow(con.execute(sql_statement).arrow())
         
         transformed = self.transform(f, new_schema = self.schema, required_columns=set(self.schema))
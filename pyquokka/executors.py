@@ -1,6 +1,7 @@
 import os
 import polars
 import pandas as pd
+import numpy as np
 os.environ['ARROW_DEFAULT_MEMORY_POOL'] = 'system'
 import redis
 import pyarrow as pa
@@ -18,8 +19,111 @@ import pyarrow.parquet as pq
 import concurrent.futures
 import duckdb
 import multiprocessing
+import threading
+import heapq
+import mmap
+from numba import njit
 from pyquokka.windowtypes import *
 
+# spill writes with O_DIRECT go out in 256 KB requests of page aligned memory
+DIRECT_IO_ALIGN = 4096
+DIRECT_IO_CHUNK = 256 * 1024
+
+# duckdb's vectorized operators scale with cores, size its pool to the machine instead of a fixed count
+DUCK_THREADS = max(1, multiprocessing.cpu_count())
+
+# one in-process duckdb database shared by every executor in this process, each executor gets its own cursor on it.
+# opening a database sets up the buffer manager and the thread pool, a cursor is just a new client context over it.
+DUCK_CONN = None
+DUCK_LOCK = threading.Lock()
+
+def get_duck_cursor():
+    global DUCK_CONN
+    with DUCK_LOCK:
+        if DUCK_CONN is None:
+            DUCK_CONN = duckdb.connect()
+            DUCK_CONN.execute('PRAGMA threads=%d' % DUCK_THREADS)
+        return DUCK_CONN.cursor()
+
+@njit(cache = True, nogil = True)
+def assign_session_ids(by_hash, ts, timeout, out):
+    # out[i] is the session id of row i, rows must be sorted on (key, time)
+    if len(ts) == 0:
+        return
+    out[0] = 0
+    for i in range(1, len(ts)):
+        if by_hash[i] != by_hash[i - 1] or ts[i] - ts[i - 1] > timeout:
+            out[i] = out[i - 1] + 1
+        else:
+            out[i] = out[i - 1]
+
+@njit(cache = True, nogil = True)
+def run_head_less(keys, pos, a, b):
+    # ties go to the lower run, so the merge is stable across runs
+    return keys[pos[a]] < keys[pos[b]] or (keys[pos[a]] == keys[pos[b]] and a < b)
+
+@njit(cache = True, nogil = True)
+def merge_sorted_runs(keys, starts, out):
+    # keys holds sorted runs back to back, run i is keys[starts[i]:starts[i + 1]]. out gets the positions in keys in
+    # merged order. the heap holds run numbers ordered by the key under each run's cursor.
+    num_runs = len(starts) - 1
+    pos = starts[:-1].copy()
+    heap = np.empty(num_runs, dtype = np.int64)
+    size = 0
+    for run in range(num_runs):
+        if pos[run] == starts[run + 1]:
+            continue
+        i = size
+        heap[i] = run
+        size += 1
+        while i > 0:
+            parent = (i - 1) // 2
+            if not run_head_less(keys, pos, heap[i], heap[parent]):
+                break
+            heap[i], heap[parent] = heap[parent], heap[i]
+            i = parent
+
+    for j in range(len(out)):
+        run = heap[0]
+        out[j] = pos[run]
+        pos[run] += 1
+        if pos[run] == starts[run + 1]:
+            size -= 1
+            heap[0] = heap[size]
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size and run_head_less(keys, pos, heap[child + 1], heap[child]):
+                child += 1
+            if not run_head_less(keys, pos, heap[child], heap[i]):
+                break
+            heap[i], heap[child] = heap[child], heap[i]
+            i = child
+
+DUCK_NUMERIC_TYPES = {"TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "FLOAT", "DOUBLE"}
+
+def null_placeholder(type_):
+    # any non null literal that casts to type_, it stands in for null in a key index next to an is null flag.
+    # None for types that have no such literal or that duckdb can't put in an index (lists, structs, maps, enums)
+    type_ = type_.upper()
+    if type_ in DUCK_NUMERIC_TYPES or type_.startswith("DECIMAL"):
+        return "0"
+    if type_ in ("VARCHAR", "BLOB"):
+        return "''"
+    if type_ == "BOOLEAN":
+        return "false"
+    if type_ in ("DATE", "TIMESTAMP", "TIMESTAMP_S", "TIMESTAMP_MS", "TIMESTAMP_NS", "TIMESTAMP WITH TIME ZONE"):
+        return "'1970-01-01'"
+    if type_ in ("TIME", "TIME WITH TIME ZONE"):
+        return "'00:00:00'"
+    if type_ == "INTERVAL":
+        return "'0 seconds'"
+    if type_ == "UUID":
+        return "'00000000-0000-0000-0000-000000000000'"
+    return None
+
 class Executor:
     def __init__(self) -> None:
         raise NotImplementedError
@@ -28,6 +132,20 @@ class Executor:
     def done(self,executor_id):
         raise NotImplementedError    
 
+    # one duckdb cursor per executor, built on first use. registered arrow views are local to the cursor so executors
+    # sharing the process database don't see each other's batch_arrow.
+    def _get_duck(self):
+        if self._duck is None:
+            self._duck = get_duck_cursor()
+        return self._duck
+
+    # the window executors build their polars aggregations on first use. the paths that run in duckdb never need them,
+    # and not every aggregation translates to polars (count(*) doesn't), so building them up front breaks those paths.
+    def _get_polars_aggregations(self):
+        if self._polars_aggregations is None:
+            self._polars_aggregations = self.window.polars_aggregations()
+        return self._polars_aggregations
+
 class UDFExecutor:
     def __init__(self, udf) -> None:
         self.udf = udf
@@ -40,7 +158,10 @@ class UDFExecutor:
 
     def execute(self,batches,stream_id, executor_id):
         batches = [i for i in batches if i is not None]
-        if len(batches) > 0:
+        if len(batches) == 1:
+            # the common streaming case, no need to concat
+            return self.udf(batches[0])
+        elif len(batches) > 0:
             return self.udf(polars.concat(batches, rechunk=False))
         else:
             return None
@@ -61,7 +182,9 @@ class StorageExecutor(Executor):
         # print("executing storage node")
         batches = [batch for batch in batches if batch is not None and len(batch) > 0]
         #print(batches)
-        if len(batches) > 0:
+        if len(batches) == 1:
+            return batches[0] if type(batches[0]) == polars.internals.DataFrame else polars.from_arrow(batches[0])
+        elif len(batches) > 0:
             if type(batches[0]) == polars.internals.DataFrame:
                 return polars.concat(batches)
             else:
@@ -79,6 +202,31 @@ We are going to support four kinds of windows:
 We will expect the batches to come in sorted order.
 """
 
+# query templates shared by the window executors. the column names and aggregations are filled in once
+# per executor in __init__, not on every batch.
+EVENT_WINDOW_SQL = """
+    SELECT 
+        BY_COL,
+        TIME_COL,
+        AGG_FUNCS
+    FROM batch_arrow
+    WINDOW win AS (
+        PARTITION BY BY_COL, WINDOW_ID
+        ORDER BY TIME_COL
+        ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+    )
+"""
+
+TUMBLING_WINDOW_SQL = """
+    SELECT 
+        BY_COL,
+        BUCKET AS TIME_COL,
+        AGG_FUNCS
+    FROM batch_arrow
+    GROUP BY BY_COL, BUCKET
+    ORDER BY TIME_COL
+"""
+
 class HoppingWindowExecutor(Executor):
     def __init__(self, time_col, by_col, window,  trigger) -> None:
         self.time_col = time_col
@@ -88,15 +236,77 @@ class HoppingWindowExecutor(Executor):
         assert issubclass(type(trigger), Trigger)
         self.window = window
         self.trigger = trigger
+        self._duck = None
+        self._polars_aggregations = None
+        # arrow schema of the tumbling results, worked out from the first batch
+        self.tumbling_schema = None
+
+        # the window id and bucket expressions depend on the time column's type, which we only see in the first batch
+        self.event_sql = EVENT_WINDOW_SQL.replace("TIME_COL", time_col).replace("BY_COL", by_col).replace("AGG_FUNCS", window.sql_aggregations())
+        self.tumbling_sql = TUMBLING_WINDOW_SQL.replace("TIME_COL", time_col).replace("BY_COL", by_col).replace("AGG_FUNCS", window.sql_group_aggregations())
 
         # hopping window - event trigger is not supported. It is very complicated and probably not worth it.
         if type(trigger) == OnEventTrigger and type(window) == HoppingWindow:
             raise Exception("OnEventTrigger is not supported for hopping windows")
 
+    def tumbling_agg(self, batch):
+        # a tumbling window is just a GROUP BY on the bucket each row falls in, and duckdb's hash aggregate
+        # does that a lot faster than groupby_dynamic. buckets are aligned to the epoch like groupby_dynamic's.
+        time_type = batch[self.time_col].dtype
+        if time_type == polars.Datetime or time_type == polars.Date:
+            origin = "DATE '1970-01-01'" if time_type == polars.Date else "TIMESTAMP '1970-01-01'"
+            bucket = "time_bucket(INTERVAL '%d microseconds', %s, %s)" % (int(self.window.size.total_seconds() * 1e6), self.time_col, origin)
+        else:
+            # floor, not truncation: the sql % takes the sign of the dividend, so negative times need the extra wrap
+            bucket = "(%s - ((%s %% %d) + %d) %% %d)" % (self.time_col, self.time_col, self.window.size, self.window.size, self.window.size)
+
+        batch_arrow = batch.to_arrow()
+        con = self._get_duck()
+        con.register("batch_arrow", batch_arrow)
+
+        result = con.execute(self.tumbling_sql.replace("BUCKET", bucket)).arrow()
+        con.unregister("batch_arrow")
+
+        # duckdb picks its own result types (integer sums come back as HUGEINT for example), cast to what the polars
+        # groupby_dynamic path gave. cast in arrow, polars would turn the decimals into floats on the way in.
+        if self.tumbling_schema is None:
+            try:
+                self.tumbling_schema = batch.head(0).groupby_dynamic(self.time_col, every = self.window.hop_polars, period = self.window.size_polars,
+                    by = self.by_col).agg(self._get_polars_aggregations()).to_arrow().schema
+            except Exception:
+                # polars can't express these aggregations, keep duckdb's types
+                self.tumbling_schema = result.schema
+        for i, field in enumerate(result.schema):
+            target = self.tumbling_schema.field(field.name).type if field.name in self.tumbling_schema.names else field.type
+            if target != field.type:
+                result = result.set_column(i, field.name, compute.cast(result.column(i), target))
+
+        return polars.from_arrow(result)
+
+    def event_agg(self, batch):
+        # rows are assigned to their tumbling window inside the query, instead of adding a window id column in polars
+        # and converting the frame again.
+        if batch[self.time_col].dtype == polars.Datetime:
+            window_id = "floor(epoch(%s) / %f)" % (self.time_col, self.window.size.total_seconds())
+        else:
+            window_id = "(%s // %d)" % (self.time_col, self.window.size)
+
+        batch_arrow = batch.to_arrow()
+        con = self._get_duck()
+        con.register("batch_arrow", batch_arrow)
+
+        result = con.execute(self.event_sql.replace("WINDOW_ID", window_id)).arrow()
+        con.unregister("batch_arrow")
+
+        return polars.from_arrow(result)
+
     def execute(self, batches, stream_id, executor_id):
         
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
-        batch = polars.concat(batches)
+        # stitch the arrow buffers together first and convert once, instead of one polars frame per batch
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return
+        batch = polars.from_arrow(pa.concat_tables(batches))
 
         # current polars implementation cannot support floating point groupby dynamic and rolling operations.
         assert (batch[self.time_col].dtype == polars.Int32 or batch[self.time_col].dtype == polars.Int64 or 
@@ -111,56 +321,35 @@ class HoppingWindowExecutor(Executor):
         timestamp_of_last_row = batch[self.time_col][-1]
         if type(timestamp_of_last_row) == datetime.datetime:
             last_start = (timestamp_of_last_row - self.window.size).timestamp() // self.window.hop.total_seconds() * self.window.hop.total_seconds()
-            last_end = last_start + self.window.size.total_seconds()
-            new_state = batch.filter(polars.col(self.time_col) > datetime.datetime.fromtimestamp(last_end))
-            batch = batch.filter(polars.col(self.time_col) <= datetime.datetime.fromtimestamp(last_end))
-            
+            last_end = np.datetime64(datetime.datetime.fromtimestamp(last_start + self.window.size.total_seconds()))
         elif type(timestamp_of_last_row) == int:
             last_start = (timestamp_of_last_row - self.window.size) // self.window.hop * self.window.hop
             last_end = last_start + self.window.size
-            new_state = batch.filter(polars.col(self.time_col) > last_end)
-            batch = batch.filter(polars.col(self.time_col) <= last_end)
         else:
             raise NotImplementedError
+
+        # the batch is sorted on time, so one binary search splits it into the completed rows and the
+        # rows that carry over. slices are views, this avoids two full filter passes.
+        split = int(np.searchsorted(batch[self.time_col].to_numpy(), last_end, side = "right"))
+        new_state = batch.slice(split, len(batch) - split)
+        batch = batch.slice(0, split)
         
         if self.state is not None:
             batch = polars.concat([self.state, batch])
         self.state = new_state
 
         if type(self.trigger) == OnCompletionTrigger:
-            # we are going to use polars groupby dynamic
-            result = batch.groupby_dynamic(self.time_col, every = hop, period= size, by = self.by_col).agg(self.window.polars_aggregations()).sort(self.time_col)
+            if self.window.hop == self.window.size:
+                result = self.tumbling_agg(batch)
+            else:
+                # we are going to use polars groupby dynamic
+                result = batch.groupby_dynamic(self.time_col, every = hop, period= size, by = self.by_col).agg(self._get_polars_aggregations()).sort(self.time_col)
 
         elif type(self.trigger) == OnEventTrigger:
         
             # we will assign a window id to each row, then use DuckDB's SQL window functions.
-            # this is not the most efficient way to do this, but it is the easiest.
-
             assert type(self.window) == TumblingWindow
-            if timestamp_of_last_row == datetime.datetime:
-                batch = batch.with_column((polars.col(self.time_col).cast(polars.Int64) // self.window.size.total_seconds()).alias("__window_id"))
-            else:
-                batch = batch.with_column((polars.col(self.time_col) // self.window.size).alias("__window_id"))
-
-            batch_arrow = batch.to_arrow()
-
-            aggregations = self.window.sql_aggregations()
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
-
-            result = con.execute("""
-                SELECT 
-                    BY_COL,
-                    TIME_COL,
-                    AGG_FUNCS
-                FROM batch_arrow
-                WINDOW win AS (
-                    PARTITION BY BY_COL, __window_id
-                    ORDER BY TIME_COL
-                    RANGE unbounded preceding
-                )
-            """.replace("TIME_COL", self.time_col).replace("BY_COL", self.by_col).replace("AGG_FUNCS", aggregations)).arrow()
-
-            result = polars.from_arrow(result)
+            result = self.event_agg(batch)
     
         else:
             raise NotImplementedError("unrecognized trigger type")
@@ -172,39 +361,16 @@ class HoppingWindowExecutor(Executor):
         if type(self.trigger) == OnCompletionTrigger:
             size = self.window.size_polars
             hop = self.window.hop_polars
-            if self.state is not None and len(self.state) > 0:
-                result = self.state.groupby_dynamic(self.time_col, every = hop, period= size, by = self.by_col).agg(self.aggregations).sort(self.time_col)
+            if self.state is not None and len(self.state) > 0 and self.window.hop == self.window.size:
+                result = self.tumbling_agg(self.state)
+            elif self.state is not None and len(self.state) > 0:
+                result = self.state.groupby_dynamic(self.time_col, every = hop, period= size, by = self.by_col).agg(self._get_polars_aggregations()).sort(self.time_col)
             else:
                 result = None
         elif type(self.trigger) == OnEventTrigger:
             assert type(self.window) == TumblingWindow
             if self.state is not None and len(self.state) > 0:
-                batch = self.state
-                timestamp_of_last_row = batch[self.time_col][-1]
-                if timestamp_of_last_row == datetime.datetime:
-                    batch = batch.with_column((polars.col(self.time_col).cast(polars.Int64) // self.window.size.total_seconds()).alias("__window_id"))
-                else:
-                    batch = batch.with_column((polars.col(self.time_col) // self.window.size).alias("__window_id"))
-
-                batch_arrow = batch.to_arrow()
-
-                aggregations = self.window.sql_aggregations()
-                con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
-
-                result = con.execute("""
-                    SELECT 
-                        BY_COL,
-                        TIME_COL,
-                        AGG_FUNCS
-                    FROM batch_arrow
-                    WINDOW win AS (
-                        PARTITION BY BY_COL, __window_id
-                        ORDER BY TIME_COL
-                        RANGE unbounded preceding
-                    )
-                """.replace("TIME_COL", self.time_col).replace("BY_COL", self.by_col).replace("AGG_FUNCS", aggregations)).arrow()
-
-                result = polars.from_arrow(result)
+                result = self.event_agg(self.state)
             else:
                 result = None
 
@@ -223,6 +389,7 @@ class SlidingWindowExecutor(Executor):
         assert issubclass(type(trigger), Trigger)
         self.window = window
         self.trigger = trigger
+        self._polars_aggregations = None
 
         # hopping window - event trigger is not supported. It is very complicated and probably not worth it.
         if type(trigger) == OnCompletionTrigger:
@@ -232,8 +399,10 @@ class SlidingWindowExecutor(Executor):
 
     def execute(self, batches, stream_id, executor_id):
 
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
-        batch = polars.concat(batches)
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return
+        batch = polars.from_arrow(pa.concat_tables(batches))
 
         # current polars implementation cannot support floating point groupby dynamic and rolling operations.
         assert (batch[self.time_col].dtype == polars.Int32 or batch[self.time_col].dtype == polars.Int64 or 
@@ -252,11 +421,12 @@ class SlidingWindowExecutor(Executor):
         # partitions = batch.partition_by(self.by_col)
         # results = []
         # for partition in partitions:
-        #     results.append(partition.groupby_rolling(self.time_col, period = size).agg(self.window.polars_aggregations()))
+        #     results.append(partition.groupby_rolling(self.time_col, period = size).agg(self._get_polars_aggregations()))
         # result = polars.concat(results)
-        result = batch.groupby_rolling(self.time_col, period= size, by = self.by_col).agg(self.window.polars_aggregations())#.sort(self.time_col)
-        if to_discard is not None:
-            result = result[to_discard:]
+        result = batch.groupby_rolling(self.time_col, period= size, by = self.by_col).agg(self._get_polars_aggregations())#.sort(self.time_col)
+        # drop the rows recomputed for the carried-over state. slice is a view, indexing would gather a copy
+        if to_discard:
+            result = result.slice(to_discard, len(result) - to_discard)
 
         return result
     
@@ -273,6 +443,9 @@ class SessionWindowExecutor(Executor):
         assert issubclass(type(trigger), Trigger)
         self.window = window
         self.trigger = trigger
+        self._duck = None
+        self._polars_aggregations = None
+        self.event_sql = EVENT_WINDOW_SQL.replace("TIME_COL", time_col).replace("BY_COL", by_col).replace("AGG_FUNCS", window.sql_aggregations()).replace("WINDOW_ID", "__window_id")
 
         # hopping window - event trigger is not supported. It is very complicated and probably not worth it.
         if type(trigger) == OnCompletionTrigger:
@@ -280,8 +453,10 @@ class SessionWindowExecutor(Executor):
             print("The completion time of a sliding window is when the last event comes, so they are the same. Timeout for completion trigger is ignored currently.")
     
     def execute(self, batches, stream_id, executor_id):
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
-        batch = polars.concat(batches)
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return
+        batch = polars.from_arrow(pa.concat_tables(batches))
 
         # current polars implementation cannot support floating point groupby dynamic and rolling operations.
         assert (batch[self.time_col].dtype == polars.Int32 or batch[self.time_col].dtype == polars.Int64 or 
@@ -291,13 +466,20 @@ class SessionWindowExecutor(Executor):
         if self.state is not None:
             batch = polars.concat([self.state, batch])
 
-        lazy_batch = batch.lazy()
-        windowed_batch = lazy_batch.select([self.time_col, self.by_col]).groupby(self.by_col).agg(
-            [
-                polars.col(self.time_col),
-                (polars.col("ts") - polars.col("ts").shift(1) > timeout).cumsum().alias("__window_id"),
-            ]
-        ).explode([self.time_col, "__window_id"]).fill_null(0).join(lazy_batch, on = [self.by_col, self.time_col]).collect()
+        # a new session starts wherever the key changes or the gap to the previous event exceeds the timeout.
+        # with the batch sorted on (key, time) a single pass numbers the sessions. the ids are unique across keys,
+        # which is all the joins below need. keys are compared by hash and times as integers in the column's unit.
+        batch = batch.sort([self.by_col, self.time_col])
+        by_hash = batch[self.by_col].hash().to_numpy()
+        ts = batch[self.time_col].to_numpy()
+        if np.issubdtype(ts.dtype, np.datetime64):
+            gap = np.timedelta64(timeout).astype("timedelta64[%s]" % np.datetime_data(ts.dtype)[0]).astype(np.int64)
+            ts = ts.view(np.int64)
+        else:
+            gap = timeout
+        window_ids = np.empty(len(ts), dtype = np.int64)
+        assign_session_ids(by_hash, ts, gap, window_ids)
+        windowed_batch = batch.with_columns(polars.Series("__window_id", window_ids))
 
         # you will need to collect rows corresponding to the last window id for each of the elements in by_col
 
@@ -307,25 +489,15 @@ class SessionWindowExecutor(Executor):
         windowed_batch = windowed_batch.join(last_window_id, on = [self.by_col, "__window_id"], how = "anti")        
 
         if type(self.trigger) == OnCompletionTrigger:
-            result = windowed_batch.groupby([self.by_col, "__window_id"]).agg(self.window.polars_aggregations())
+            result = windowed_batch.groupby([self.by_col, "__window_id"]).agg(self._get_polars_aggregations())
         elif type(self.trigger) == OnEventTrigger:
             batch_arrow = windowed_batch.to_arrow()
 
-            aggregations = self.window.sql_aggregations()
-            con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
-
-            result = con.execute("""
-                SELECT 
-                    BY_COL,
-                    TIME_COL,
-                    AGG_FUNCS
-                FROM batch_arrow
-                WINDOW win AS (
-                    PARTITION BY BY_COL, __window_id
-                    ORDER BY TIME_COL
-                    RANGE unbounded preceding
-                )
-            """.replace("TIME_COL", self.time_col).replace("BY_COL", self.by_col).replace("AGG_FUNCS", aggregations)).arrow()
+            con = self._get_duck()
+            con.register("batch_arrow", batch_arrow)
+
+            result = con.execute(self.event_sql).arrow()
+            con.unregister("batch_arrow")
 
         return result
 
@@ -335,25 +507,15 @@ class SessionWindowExecutor(Executor):
             return 
         else:
             if type(self.trigger) == OnCompletionTrigger:
-                result = self.state.with_column(polars.lit(1).alias("__window_id")).groupby("__window_id").agg(self.window.polars_aggregations())
+                result = self.state.with_columns(polars.lit(1).alias("__window_id")).groupby("__window_id").agg(self._get_polars_aggregations())
             elif type(self.trigger) == OnEventTrigger:
                 batch_arrow = self.state.to_arrow()
 
-                aggregations = self.window.sql_aggregations()
-                con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
-
-                result = con.execute("""
-                    SELECT 
-                        BY_COL,
-                        TIME_COL,
-                        AGG_FUNCS
-                    FROM batch_arrow
-                    WINDOW win AS (
-                        PARTITION BY BY_COL, __window_id
-                        ORDER BY TIME_COL
-                        RANGE unbounded preceding
-                    )
-                """.replace("TIME_COL", self.time_col).replace("BY_COL", self.by_col).replace("AGG_FUNCS", aggregations)).arrow()
+                con = self._get_duck()
+                con.register("batch_arrow", batch_arrow)
+
+                result = con.execute(self.event_sql).arrow()
+                con.unregister("batch_arrow")
         
             return result
         
@@ -369,57 +531,73 @@ class OutputExecutor(Executor):
         self.name = 0
         self.region = region
         self.executor = None
+        self.fs = None
 
     def upload_write_batch(self, write_batch, executor_id):
 
+        if self.fs is None:
+            self.fs = LocalFileSystem() if self.region == "local" else S3FileSystem(region=self.region)
+
+        if self.format == "parquet":
+            # all the row groups of this write go into one file, so the footer and column metadata are written once
+            # per upload instead of once per row group
+            filename = self.prefix + "-" + str(executor_id) + "-" + str(self.name) + "." + self.format
+            self.name += 1
+            with pq.ParquetWriter(self.filepath + "/" + filename, write_batch.schema, filesystem = self.fs, compression = "snappy", use_dictionary = True) as writer:
+                writer.write_table(write_batch, row_group_size = self.row_group_size)
+            return [filename]
+
+        # csv has no row groups, write one file per row_group_size slice on a thread pool
         if self.executor is None:
             self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count())
-            self.fs = LocalFileSystem() if self.region == "local" else S3FileSystem(region=self.region)
 
-        def upload_parquet(table, where):
-            pq.write_table(table, where, filesystem=self.fs)
-            return True
         def upload_csv(table, where):
             f = self.fs.open_output_stream(where)
             csv.write_csv(table, f)
             f.close()
             return True
         
-        if self.format == "csv":
-            for i, (col_name, type_) in enumerate(zip(write_batch.schema.names, write_batch.schema.types)):
-                if pa.types.is_decimal(type_):
-                    write_batch = write_batch.set_column(i, col_name, compute.cast(write_batch.column(col_name), pa.float64()))
+        for i, (col_name, type_) in enumerate(zip(write_batch.schema.names, write_batch.schema.types)):
+            if pa.types.is_decimal(type_):
+                write_batch = write_batch.set_column(i, col_name, compute.cast(write_batch.column(col_name), pa.float64()))
 
         futures = []
+        filenames = []
 
         for i in range(0, len(write_batch), self.row_group_size):
             current_batch = write_batch[i : i + self.row_group_size]
-            basename_template = self.filepath + "/" + self.prefix + "-" + str(executor_id) + "-" + str(self.name)  + "." + self.format
+            filename = self.prefix + "-" + str(executor_id) + "-" + str(self.name)  + "." + self.format
             self.name += 1
-            if self.format == "parquet":
-                futures.append(self.executor.submit(upload_parquet, current_batch, basename_template))
-            else:
-                futures.append(self.executor.submit(upload_csv, current_batch, basename_template))
+            filenames.append(filename)
+            futures.append(self.executor.submit(upload_csv, current_batch, self.filepath + "/" + filename))
         
         assert all([fut.result() for fut in futures])
+        return filenames
 
     def execute(self,batches,stream_id, executor_id):
 
-        import numpy as np
-
         self.my_batches.extend([i for i in batches if i is not None and len(i) > 0])
 
+        # only a handful of batches are buffered, plain python arithmetic beats numpy dispatch here
         lengths = [len(batch) for batch in self.my_batches]
-        total_len = np.sum(lengths)
+        total_len = sum(lengths)
 
         if total_len <= self.row_group_size:
             return
 
         write_len = total_len // self.row_group_size * self.row_group_size
-        full_batches_to_take = np.where(np.cumsum(lengths) >= write_len)[0][0]        
+
+        # find the first batch where the running sum reaches write_len, and the rows before it
+        acc_prev = 0
+        full_batches_to_take = 0
+        for i, length in enumerate(lengths):
+            if acc_prev + length >= write_len:
+                full_batches_to_take = i
+                break
+            acc_prev += length
 
         write_batch = pa.concat_tables(self.my_batches[:full_batches_to_take]) if full_batches_to_take > 0 else None
-        rows_to_take = int(write_len - np.sum(lengths[:full_batches_to_take]))
+        rows_to_take = write_len - acc_prev
         self.my_batches = self.my_batches[full_batches_to_take:]
         if rows_to_take > 0:
             if write_batch is not None:
@@ -431,16 +609,16 @@ class OutputExecutor(Executor):
         assert len(write_batch) % self.row_group_size == 0
         # print("WRITING", self.filepath,self.mode )
 
-        self.upload_write_batch(write_batch, executor_id)
+        filenames = self.upload_write_batch(write_batch, executor_id)
 
-        return_df = polars.from_dict({"filename":[(self.prefix + "-" + str(executor_id) + "-" + str(self.name) + "-" + str(i) + "." + self.format) for i in range(len(write_batch) // self.row_group_size) ]})
+        return_df = polars.from_dict({"filename": filenames})
         return return_df
 
     def done(self,executor_id):
         df = pa.concat_tables(self.my_batches)
-        self.upload_write_batch(df, executor_id)
+        filenames = self.upload_write_batch(df, executor_id)
         
-        return_df = polars.from_dict({"filename":[(self.prefix + "-" + str(executor_id) + "-" + str(self.name) + "-" + str(i) + "." + self.format) for i in range((len(df) -1) // self.row_group_size + 1) ]})
+        return_df = polars.from_dict({"filename": filenames})
         return return_df
 
 class BroadcastJoinExecutor(Executor):
@@ -470,6 +648,10 @@ class BroadcastJoinExecutor(Executor):
             self.big_on = big_on
         
         assert self.small_on in self.state.columns
+
+        # the small table is joined against every batch, lay it out as one contiguous chunk up front
+        # so each hash build walks flat buffers
+        self.state = self.state.rechunk()
     
     def checkpoint(self, conn, actor_id, channel_id, seq):
         pass
@@ -480,10 +662,10 @@ class BroadcastJoinExecutor(Executor):
     # the execute function signature does not change. stream_id will be a [0 - (length of InputStreams list - 1)] integer
     def execute(self,batches, stream_id, executor_id):
         # state compaction
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
+        batches = [i for i in batches if i is not None and len(i) > 0]
         if len(batches) == 0:
             return
-        batch = polars.concat(batches)
+        batch = polars.from_arrow(pa.concat_tables(batches))
         return batch.join(self.state, left_on = self.big_on, right_on = self.small_on, how = self.how, suffix = self.suffix)
         
     def done(self,executor_id):
@@ -511,32 +693,37 @@ class BuildProbeJoinExecutor(Executor):
         assert how in {"inner", "left", "semi", "anti"}
         self.how = how
         self.key_to_keep = key_to_keep
-        self.things_seen = []
+        # batches seen per stream, only used in the assertion message below
+        self.things_seen = [0, 0]
+        self.build_chunks = []
 
     def execute(self,batches, stream_id, executor_id):
         # state compaction
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
+        batches = [i for i in batches if i is not None and len(i) > 0]
         if len(batches) == 0:
             return
-        batch = polars.concat(batches)
-        self.things_seen.append((stream_id, len(batches)))
+        batch = polars.from_arrow(pa.concat_tables(batches))
+        self.things_seen[stream_id] += 1
 
         # build
         if stream_id == 1:
             assert self.phase == "build", (self.left_on, self.right_on, self.things_seen)
-            self.state = batch if self.state is None else self.state.vstack(batch, in_place = True)
+            self.build_chunks.append(batch)
                
         # probe
         elif stream_id == 0:
+            # the build side is complete once probing starts. concat it once here instead of vstacking every batch.
+            # the hash join does not need it sorted.
+            if self.phase == "build":
+                self.state = polars.concat(self.build_chunks, rechunk = True) if len(self.build_chunks) > 0 else None
+                self.build_chunks = []
+                self.phase = "probe"
             if self.state is None:
                 if self.how == "anti":
                     return batch
                 else:
                     return
             # print("STATE LEN", len(self.state))
-            if self.phase == "build":
-                self.state = self.state.sort(self.right_on)
-            self.phase = "probe"
             result = batch.join(self.state,left_on = self.left_on, right_on = self.right_on ,how= self.how)
             if self.key_to_keep == "right":
                 result = result.rename({self.left_on: self.right_on})
@@ -548,8 +735,9 @@ class BuildProbeJoinExecutor(Executor):
 class DistinctExecutor(Executor):
     def __init__(self, keys) -> None:
 
-        self.keys = keys
-        self.state = None
+        self.keys = [keys] if type(keys) == str else keys
+        self.state_table = None
+        self._duck = None
     
     def checkpoint(self, conn, actor_id, channel_id, seq):
         pass
@@ -559,19 +747,53 @@ class DistinctExecutor(Executor):
 
     def execute(self, batches, stream_id, executor_id):
         
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
+        batches = [i for i in batches if i is not None and len(i) > 0]
         if len(batches) == 0:
             return
-        batch = polars.concat(batches)
-        batch = batch.unique()
-
-        if self.state is None:
-            self.state = batch
-            return batch
+        batch_arrow = pa.concat_tables(batches)
+        # the row number makes the first occurrence of a key in the batch the one that is kept
+        batch_arrow = batch_arrow.append_column("__row", pa.array(np.arange(len(batch_arrow))))
+
+        # the seen rows live in a duckdb table with a primary key, so every batch is one probe per row into the key's
+        # index instead of a join against the whole state. a primary key makes its columns NOT NULL while null keys are
+        # legitimate distinct values here, so the index is on a (is null, value or a placeholder) pair per key column.
+        # keys duckdb can't index (lists, structs) fall back to an anti join against the whole state, where
+        # IS NOT DISTINCT FROM matches null to null.
+        con = self._get_duck()
+        con.register("batch_arrow", batch_arrow)
+        keys = ", ".join('"' + key + '"' for key in self.keys)
+        if self.state_table is None:
+            self.state_table = "distinct_state"
+            schema = [(name, type_) for name, type_, *_ in con.execute("DESCRIBE SELECT * EXCLUDE (__row) FROM batch_arrow").fetchall()]
+            types = dict(schema)
+            self.state_columns = ", ".join('"' + name + '"' for name, _ in schema)
+            placeholders = [null_placeholder(types[key]) for key in self.keys]
+            # temp tables belong to this executor's cursor, the database itself is shared with the rest of the process
+            if all(placeholder is not None for placeholder in placeholders):
+                self.index_exprs = []
+                col_defs = ['"' + name + '" ' + type_ for name, type_ in schema]
+                for i, (key, placeholder) in enumerate(zip(self.keys, placeholders)):
+                    self.index_exprs += ['"' + key + '" IS NULL', 'COALESCE("' + key + '", CAST(' + placeholder + ' AS ' + types[key] + '))']
+                    col_defs += ['"__null_' + str(i) + '" BOOLEAN', '"__key_' + str(i) + '" ' + types[key]]
+                index_cols = ", ".join('"__null_' + str(i) + '", "__key_' + str(i) + '"' for i in range(len(self.keys)))
+                con.execute("CREATE TEMP TABLE " + self.state_table + " (" + ", ".join(col_defs) + ", PRIMARY KEY (" + index_cols + "))")
+            else:
+                self.index_exprs = None
+                con.execute("CREATE TEMP TABLE " + self.state_table + " AS SELECT * EXCLUDE (__row) FROM batch_arrow LIMIT 0")
+
+        # first occurrence of every key in the batch, in batch order. window partitions group nulls together.
+        first = "SELECT * EXCLUDE (__row) FROM batch_arrow b WHERE_SEEN QUALIFY row_number() OVER (PARTITION BY " + keys + " ORDER BY __row) = 1 ORDER BY __row"
+        if self.index_exprs is not None:
+            # the primary key drops what earlier batches had
+            contribution = con.execute("INSERT INTO " + self.state_table + " SELECT *, " + ", ".join(self.index_exprs) +
+                " FROM (" + first.replace("WHERE_SEEN", "") + ") ON CONFLICT DO NOTHING RETURNING " + self.state_columns).arrow()
         else:
-            contribution = batch.join(self.state, on = self.keys, how="anti")
-            self.state.vstack(contribution, in_place = True)
-            return contribution
+            seen = " AND ".join('s."' + key + '" IS NOT DISTINCT FROM b."' + key + '"' for key in self.keys)
+            contribution = con.execute("INSERT INTO " + self.state_table + " " +
+                first.replace("WHERE_SEEN", "WHERE NOT EXISTS (SELECT 1 FROM " + self.state_table + " s WHERE " + seen + ")") +
+                " RETURNING " + self.state_columns).arrow()
+        con.unregister("batch_arrow")
+        return polars.from_arrow(contribution)
     
     def serialize(self):
         return {0:self.seen}, "all"
@@ -606,25 +828,30 @@ class SQLAggExecutor(Executor):
                     self.agg_clause += key + ","
             self.agg_clause = self.agg_clause[:-1]
         
-        self.state = None
+        self.state_chunks = []
+        self._duck = None
     
     def execute(self, batches, stream_id, executor_id):
-        batch = pa.concat_tables(batches)
-        self.state = batch if self.state is None else pa.concat_tables([self.state, batch])
+        # concatenating into the state on every call is quadratic, collect the tables and concat once in done
+        self.state_chunks.extend(batches)
 
     def done(self, executor_id):
-        if self.state is None:
+        if len(self.state_chunks) == 0:
             return None
-        con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
-        batch_arrow = self.state
-        self.state = polars.from_arrow(con.execute(self.agg_clause).arrow())
+        con = self._get_duck()
+        batch_arrow = pa.concat_tables(self.state_chunks)
+        self.state_chunks = []
+        con.register("batch_arrow", batch_arrow)
+        result = polars.from_arrow(con.execute(self.agg_clause).arrow())
+        con.unregister("batch_arrow")
         del batch_arrow        
-        return self.state
+        return result
 
 class SortedAsofExecutor(Executor):
     def __init__(self, time_col_trades = 'time', time_col_quotes = 'time', symbol_col_trades = 'symbol', symbol_col_quotes = 'symbol', suffix = "_right") -> None:
-        self.trade_state = None
-        self.quote_state = None
+        # both sides are kept as lists of sorted chunks, only concatenated when a join actually runs
+        self.trade_chunks = []
+        self.quote_chunks = []
         self.join_state = None
         self.time_col_trades = time_col_trades
         self.time_col_quotes = time_col_quotes
@@ -632,60 +859,70 @@ class SortedAsofExecutor(Executor):
         self.symbol_col_quotes = symbol_col_quotes
         self.suffix = suffix
 
+    def append_sorted(self, chunks, batch, time_col):
+        if len(batch) == 0:
+            return
+        if len(chunks) > 0:
+            assert chunks[-1][time_col][-1] <= batch[time_col][0]
+        chunks.append(batch)
+
     def execute(self,batches,stream_id, executor_id):    
         # sort_col = self.time_col_trades if stream_id == 0 else self.time_col_quotes
         # batch = polars.from_arrow(pa.concat_tables([batch.sort_by(sort_col) for batch in batches]))
         batch = polars.from_arrow(pa.concat_tables(batches))
         if stream_id == 0:
             # assert batch[self.time_col_trades].is_sorted()
-            if self.trade_state is None:
-                self.trade_state = batch
-            else:
-                if len(self.trade_state) > 0:
-                    assert self.trade_state[self.time_col_trades][-1] <= batch[self.time_col_trades][0]
-                self.trade_state.vstack(batch, in_place = True)
+            self.append_sorted(self.trade_chunks, batch, self.time_col_trades)
         else:
             # assert batch[self.time_col_quotes].is_sorted()
-            if self.quote_state is None:
-                self.quote_state = batch
-            else:
-                if len(self.quote_state) > 0:
-                    assert self.quote_state[self.time_col_quotes][-1] <= batch[self.time_col_quotes][0]
-                self.quote_state.vstack(batch, in_place = True)
+            self.append_sorted(self.quote_chunks, batch, self.time_col_quotes)
 
-        if self.trade_state is None or self.quote_state is None or len(self.trade_state) == 0 or len(self.quote_state) == 0:
+        if len(self.trade_chunks) == 0 or len(self.quote_chunks) == 0:
             return
 
-        joinable_trades = self.trade_state.filter(polars.col(self.time_col_trades) < self.quote_state[self.time_col_quotes][-1])
-        if len(joinable_trades) == 0:
+        # both sides are sorted, so the first trade and the last quote tell us if anything is joinable yet
+        last_quote_time = self.quote_chunks[-1][self.time_col_quotes][-1]
+        if self.trade_chunks[0][self.time_col_trades][0] >= last_quote_time:
             return
+
+        trade_state = polars.concat(self.trade_chunks, rechunk = True)
+        quote_state = polars.concat(self.quote_chunks, rechunk = True)
+        self.trade_chunks = [trade_state]
+        self.quote_chunks = [quote_state]
+
+        joinable_trades = trade_state.filter(polars.col(self.time_col_trades) < last_quote_time)
         
-        joinable_quotes = self.quote_state.filter(polars.col(self.time_col_quotes) <= joinable_trades[self.time_col_trades][-1])
+        joinable_quotes = quote_state.filter(polars.col(self.time_col_quotes) <= joinable_trades[self.time_col_trades][-1])
         if len(joinable_quotes) == 0:
             return
 
-        self.trade_state =  self.trade_state.filter(polars.col(self.time_col_trades) >= self.quote_state[self.time_col_quotes][-1])
+        trade_state = trade_state.filter(polars.col(self.time_col_trades) >= last_quote_time)
+        self.trade_chunks = [trade_state] if len(trade_state) > 0 else []
 
         result = joinable_trades.join_asof(joinable_quotes, left_on = self.time_col_trades, right_on = self.time_col_quotes, by_left = self.symbol_col_trades, by_right = self.symbol_col_quotes, suffix = self.suffix)
 
         mock_result = joinable_quotes.join_asof(joinable_trades, left_on = self.time_col_quotes, right_on = self.time_col_trades, by_left = self.symbol_col_quotes, by_right = self.symbol_col_trades, suffix = self.suffix, strategy = "forward").drop_nulls()
         latest_joined_quotes = mock_result.groupby(self.symbol_col_quotes).agg([polars.max(self.time_col_quotes)])
-        start = time.time()
-        new_quote_state = self.quote_state.join(latest_joined_quotes, on = self.symbol_col_quotes, how = "left", suffix = "_latest").fill_null(-1)
-        print("join time: ", time.time() - start)
-        self.quote_state = new_quote_state.filter(polars.col(self.time_col_quotes) >= polars.col(self.time_col_quotes + "_latest")).drop([self.time_col_quotes + "_latest"])
+        new_quote_state = quote_state.join(latest_joined_quotes, on = self.symbol_col_quotes, how = "left", suffix = "_latest").fill_null(-1)
+        quote_state = new_quote_state.filter(polars.col(self.time_col_quotes) >= polars.col(self.time_col_quotes + "_latest")).drop([self.time_col_quotes + "_latest"])
+        self.quote_chunks = [quote_state] if len(quote_state) > 0 else []
 
         # print(len(result))
 
         return result
     
     def done(self, executor_id):
-        return self.trade_state.join_asof(self.quote_state, left_on = self.time_col_trades, right_on = self.time_col_quotes, by_left = self.symbol_col_trades, by_right = self.symbol_col_quotes, suffix = self.suffix)
+        if len(self.trade_chunks) == 0 or len(self.quote_chunks) == 0:
+            return
+        trade_state = polars.concat(self.trade_chunks, rechunk = True)
+        quote_state = polars.concat(self.quote_chunks, rechunk = True)
+        return trade_state.join_asof(quote_state, left_on = self.time_col_trades, right_on = self.time_col_quotes, by_left = self.symbol_col_trades, by_right = self.symbol_col_quotes, suffix = self.suffix)
 
 class ConcatThenSQLExecutor(Executor):
     def __init__(self, sql_statement) -> None:
         self.statement = sql_statement
-        self.state = None
+        self.state_chunks = []
+        self._duck = None
 
     def checkpoint(self, conn, actor_id, channel_id, seq):
         pass
@@ -694,18 +931,20 @@ class ConcatThenSQLExecutor(Executor):
         pass
 
     def execute(self, batches, stream_id, executor_id):
-        batch = pa.concat_tables(batches)
-        self.state = batch if self.state is None else pa.concat_tables([self.state, batch])
+        self.state_chunks.extend(batches)
     
     def done(self, executor_id):
 
-        if self.state is None:
+        if len(self.state_chunks) == 0:
             return None
-        con = duckdb.connect().execute('PRAGMA threads=%d' % 8)
-        batch_arrow = self.state
-        self.state = polars.from_arrow(con.execute(self.statement).arrow())
+        con = self._get_duck()
+        batch_arrow = pa.concat_tables(self.state_chunks)
+        self.state_chunks = []
+        con.register("batch_arrow", batch_arrow)
+        result = polars.from_arrow(con.execute(self.statement).arrow())
+        con.unregister("batch_arrow")
         del batch_arrow        
-        return self.state
+        return result
 
 class CountExecutor(Executor):
     def __init__(self) -> None:
@@ -720,7 +959,8 @@ class CountExecutor(Executor):
 
     def execute(self, batches, stream_id, executor_id):
         
-        self.state += sum(len(batch) for batch in batches)
+        # map keeps the loop in C, no generator frame per call
+        self.state += sum(map(len, batches))
     
     def done(self, executor_id):
         #print("COUNT:", self.state)
@@ -730,106 +970,240 @@ class CountExecutor(Executor):
 
 
 class SuperFastSortExecutor(Executor):
-    def __init__(self, key, record_batch_rows = 100000, output_batch_rows = 1000000, file_prefix = "mergesort") -> None:
+    def __init__(self, key, record_batch_rows = 100000, output_batch_rows = 1000000, file_prefix = "mergesort", data_dir = "/data/", use_direct_io = False) -> None:
         self.key = key
         self.record_batch_rows = record_batch_rows
         self.output_batch_rows = output_batch_rows
         self.fileno = 0
         self.prefix = file_prefix # make sure this is different for different executors
-        self.data_dir = "/data/"
-        self.in_mem_state = None
+        # sorted runs are written here as Arrow IPC files and memory mapped back in done().
+        # if the runs fit in RAM, point this at /dev/shm/ to skip the disk writes entirely, the mmap reads stay zero-copy.
+        self.data_dir = data_dir if data_dir.endswith("/") else data_dir + "/"
+        # write the runs with O_DIRECT so spilling doesn't evict the working set from the page cache. only for real
+        # block devices (NVMe), tmpfs (/dev/shm) does not support it.
+        assert not use_direct_io or hasattr(os, "O_DIRECT"), "O_DIRECT is not available on this platform"
+        self.use_direct_io = use_direct_io
         self.executor = None
+        self.pending_writes = deque()
+        self.sources = None
+
+    def write_batches(self, sink, schema, batches):
+        # write the run and note where each record batch message lands in the file, done() reads the batches straight
+        # off those offsets instead of going through the ipc file reader. the writer puts the schema out lazily, so the
+        # first range can also hold the schema message. it starts past the 8 byte file magic either way.
+        writer = pa.ipc.new_file(sink, schema)
+        offsets = []
+        for batch in batches:
+            start = max(sink.tell(), 8)
+            writer.write(batch)
+            offsets.append((start, sink.tell() - start))
+        writer.close()
+        return np.array(offsets, dtype = np.int64).reshape(-1, 2)
+
+    def write_out_direct(self, target_filepath, arrow_table, batches):
+        sink = pa.BufferOutputStream()
+        offsets = self.write_batches(sink, arrow_table.schema, batches)
+        buf = sink.getvalue()
+
+        # O_DIRECT wants page aligned memory and lengths: an anonymous map is page aligned, pad it to a whole page
+        # and cut the file back to the real size at the end
+        size = buf.size
+        aligned = mmap.mmap(-1, (size + DIRECT_IO_ALIGN - 1) // DIRECT_IO_ALIGN * DIRECT_IO_ALIGN)
+        aligned[:size] = memoryview(buf)
+        view = memoryview(aligned)
+        fd = os.open(target_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        try:
+            for offset in range(0, len(aligned), DIRECT_IO_CHUNK):
+                os.pwrite(fd, view[offset : offset + DIRECT_IO_CHUNK], offset)
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+            view.release()
+            aligned.close()
+        return offsets
 
     def write_out_df_to_disk(self, target_filepath, input_mem_table):
         arrow_table = input_mem_table.to_arrow()
         batches = arrow_table.to_batches(1000000)
-        writer =  pa.ipc.new_file(pa.OSFile(target_filepath, 'wb'), arrow_table.schema)
-        for batch in batches:
-            writer.write(batch)
-        writer.close()
+        if self.use_direct_io:
+            offsets = self.write_out_direct(target_filepath, arrow_table, batches)
+        else:
+            # the ipc writer issues a write per message header and per column buffer. the buffered stream
+            # coalesces those into large writes, so a run costs a handful of syscalls instead of several per column.
+            sink = pa.BufferedOutputStream(pa.OSFile(target_filepath, 'wb'), buffer_size = 8 * 1024 * 1024)
+            offsets = self.write_batches(sink, arrow_table.schema, batches)
+            sink.close()
         # input_mem_table.write_parquet(target_filepath, row_group_size = self.record_batch_rows, use_pyarrow =True)
+        # (offset, length) of every record batch message, as int64 pairs
+        offsets.tofile(target_filepath + ".offsets")
 
         return True
 
     def execute(self, batches, stream_id, executor_id):
 
-        import numpy as np
-
-        # if self.executor is None:
-        #     self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        # spills are written on a background thread so the ipc write (which releases the gil) overlaps with
+        # the next call's sort. created lazily, thread pools don't survive pickling the executor.
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
-        # we are going to update the in memory index and flush out the sorted stuff
-        
-        flush_file_name = self.data_dir + self.prefix + "-" + str(executor_id) + "-" + str(self.fileno) + ".arrow"
-        batches = [polars.from_arrow(i) for i in batches if i is not None and len(i) > 0]
+        # sort what we got and flush it out as sorted runs, done() merges the runs
+        batches = [i for i in batches if i is not None and len(i) > 0]
         if len(batches) == 0:
             return None
         
-        start = time.time()
-        batch = polars.concat(batches)
-        print("concat execute used", time.time() - start)
-
-        start = time.time()
-        sorted_batch = batch.sort(self.key)
-        print("sort execute used", time.time() - start)
-        
-        start = time.time()
-        self.write_out_df_to_disk(flush_file_name, sorted_batch)
-        # future = self.executor.submit(self.write_out_df_to_disk, flush_file_name, sorted_batch)
-        print("flush execute used", time.time() - start)
-
-        start = time.time()
-        new_in_mem_state = polars.from_dict({ "values": sorted_batch[self.key], "file_no": np.ones(len(batch), dtype=np.int32) * self.fileno})
-        if self.in_mem_state is None:
-            self.in_mem_state = new_in_mem_state
+        # one conversion for the whole input rather than one per arrow table. the sort gathers into fresh columns
+        # anyway, so keep the chunks as they are instead of copying everything into one first.
+        batch = polars.from_arrow(pa.concat_tables(batches), rechunk = False)
+
+        # a big input is cut into one slice per polars thread and the slices are sorted concurrently, each one
+        # becomes its own run. done() is a k-way merge already so more runs cost it little, while a single
+        # sort over one large chunk doesn't always use every core.
+        num_threads = polars.threadpool_size()
+        if num_threads > 1 and len(batch) >= num_threads * self.record_batch_rows:
+            step = (len(batch) + num_threads - 1) // num_threads
+            sorted_runs = polars.collect_all([batch.slice(k, step).lazy().sort(self.key) for k in range(0, len(batch), step)])
         else:
-            self.in_mem_state.vstack(new_in_mem_state, in_place=True)
+            sorted_runs = [batch.sort(self.key)]
         
-        print("update execute state used", time.time() - start)
-        
-        # assert future.result()
-        self.fileno += 1
+        # bound the number of sorted inputs waiting in memory for their writes
+        while len(self.pending_writes) >= 2:
+            assert self.pending_writes.popleft().result()
+        for sorted_run in sorted_runs:
+            flush_file_name = self.data_dir + self.prefix + "-" + str(executor_id) + "-" + str(self.fileno) + ".arrow"
+            self.pending_writes.append(self.executor.submit(self.write_out_df_to_disk, flush_file_name, sorted_run))
+            self.fileno += 1
         
     
     def done(self, executor_id):
 
-        # first sort the in memory state
-        print("STARTING DONE", time.time())
-        self.in_mem_state = self.in_mem_state.sort("values")
-        
-        # load the cache
-        num_sources = self.fileno 
-        sources =  {i : pa.ipc.open_file(pa.memory_map( self.data_dir + self.prefix + "-" + str(executor_id) + "-" + str(i) + ".arrow"  , 'rb')) for i in range(num_sources)}
-        number_of_batches_in_source = { source: sources[source].num_record_batches for source in sources}
-        cached_batches = {i : polars.from_arrow( pa.Table.from_batches([sources[i].get_batch(0)]) ) for i in sources}
-        current_number_for_source = {i: 1 for i in sources}
-
-        print("END DONE SETUP", time.time())
-
-        # now start assembling batches of the output
-        for k in range(0, len(self.in_mem_state), self.output_batch_rows):
-
-            start = time.time()
-
-            things_to_get = self.in_mem_state[k : k + self.output_batch_rows]
-            file_requirements = things_to_get.groupby("file_no").count()
-            desired_batches = []
-            for i in range(len(file_requirements)):
-                desired_length = file_requirements["count"][i]
-                source = file_requirements["file_no"][i]
-                while desired_length > len(cached_batches[source]):
-                    if current_number_for_source[source] == number_of_batches_in_source[source]:
-                        raise Exception
-                    else:
-                        cached_batches[source].vstack(polars.from_arrow( pa.Table.from_batches( [sources[source].get_batch(current_number_for_source[source])])), in_place=True)
-                        current_number_for_source[source] += 1
+        # every run has to be on disk before we map it
+        while len(self.pending_writes) > 0:
+            assert self.pending_writes.popleft().result()
+
+        num_sources = self.fileno
+        if num_sources == 0:
+            return
+
+        # the memory maps are held on the executor for the whole merge: the polars frames below alias the mapped IPC
+        # buffers directly (rechunk=False keeps from_arrow from copying them out), so the maps have to outlive every
+        # frame built from them.
+        filenames = [self.data_dir + self.prefix + "-" + str(executor_id) + "-" + str(i) + ".arrow" for i in range(num_sources)]
+        self.sources = [pa.memory_map(filename, 'rb').read_buffer() for filename in filenames]
+        sources = self.sources
+        # batch locations come from the sidecar written with each run, so there's no footer to parse and no per batch
+        # reader dispatch. the schema message sits right after the 8 byte file magic.
+        offsets = [np.fromfile(filename + ".offsets", dtype = np.int64).reshape(-1, 2) for filename in filenames]
+        schema = pa.ipc.read_schema(pa.ipc.read_message(sources[0].slice(8)))
+        # dictionary columns (categoricals) need the dictionary batches the file reader tracks, go through it for those
+        if any(pa.types.is_dictionary(field.type) for field in schema):
+            readers = [pa.ipc.open_file(source) for source in sources]
+            read_batch = lambda source, j: readers[source].get_batch(j)
+        else:
+            def read_batch(source, j):
+                start, length = offsets[source][j]
+                messages = pa.ipc.MessageReader.open_stream(sources[source].slice(int(start), int(length)))
+                message = messages.read_next_message()
+                while message.type != "record batch":
+                    message = messages.read_next_message()
+                return pa.ipc.read_record_batch(message, schema)
+        # per run cursor state, indexed by run number. cached_batches[i] is None once run i is exhausted. the merge stays
+        # in arrow end to end: cached_batches holds record batches over the mapped files and cached_keys the numpy view
+        # of their key column, taken once per batch. row_cursor[i] is the first row of cached_batches[i] not merged yet,
+        # the batch is never re-sliced, just dropped once the cursor reaches its end.
+        number_of_batches_in_source = np.array([len(offset) for offset in offsets], dtype = np.int32)
+        current_number_for_source = np.zeros(num_sources, dtype = np.int32)
+        cached_batches = [None] * num_sources
+        cached_keys = [None] * num_sources
+        row_cursor = np.zeros(num_sources, dtype = np.int64)
+        # polars sorts nulls first, so the null keys of a run are its leading rows. they can't go through the numpy views
+        # (nulls there are NaN or garbage and break searchsorted), so load_next moves them here and they are emitted
+        # ahead of the merge. the first load of every run happens before the merge starts, and it only stops at a batch
+        # that has non null keys, so every null is collected by then.
+        null_pieces = []
+
+        def load_next(source):
+            # returns False once the run is exhausted
+            while current_number_for_source[source] < number_of_batches_in_source[source]:
+                batch = read_batch(source, int(current_number_for_source[source]))
+                current_number_for_source[source] += 1
+                nulls = batch.column(self.key).null_count
+                if nulls > 0:
+                    null_pieces.append(batch.slice(0, nulls))
+                    batch = batch.slice(nulls)
+                if batch.num_rows > 0:
+                    cached_batches[source] = batch
+                    cached_keys[source] = batch.column(self.key).to_numpy(zero_copy_only = False)
+                    row_cursor[source] = 0
+                    return True
+            cached_batches[source] = None
+            cached_keys[source] = None
+            return False
+
+        # k-way merge of the sorted runs. the heap is keyed on the last key of each run's cached batch: the smallest
+        # of those is a bound such that every cached row <= bound, across all runs, precedes everything not loaded yet.
+        heap = [(cached_keys[source][-1], source) for source in range(num_sources) if load_next(source)]
+        heapq.heapify(heap)
+
+        if len(null_pieces) > 0:
+            nulls = pa.Table.from_batches(null_pieces)
+            null_pieces = []
+            for k in range(0, len(nulls), self.output_batch_rows):
+                yield nulls.slice(k, self.output_batch_rows)
+            del nulls
+
+        while len(heap) > 0:
+            bound, exhausted = heapq.heappop(heap)
+
+            pieces = []
+            piece_keys = []
+            for source in range(num_sources):
+                batch = cached_batches[source]
+                if batch is None:
+                    continue
+                keys = cached_keys[source]
+                start = int(row_cursor[source])
+                # bounds only grow, so everything before the cursor is <= bound and searching the whole batch is fine
+                if source == exhausted:
+                    end = len(keys)
                 else:
-                    desired_batches.append(cached_batches[source][:desired_length])
-                    cached_batches[source] = cached_batches[source][desired_length:]
-            
-            result = polars.concat(desired_batches).sort(self.key)
-            print("yield one took", time.time() - start)
-            yield result
+                    end = int(np.searchsorted(keys, bound, side = "right"))
+                if end > start:
+                    pieces.append(batch.slice(start, end - start))
+                    piece_keys.append(keys[start:end])
+                    row_cursor[source] = end
+
+            if load_next(exhausted):
+                heapq.heappush(heap, (cached_keys[exhausted][-1], exhausted))
+
+            if len(pieces) == 0:
+                continue
+
+            keys = np.concatenate(piece_keys)
+            # the numpy views are only the key values where the arrow column has no nulls. load_next keeps nulls out of
+            # the cached batches, but check rather than merge on garbage: with nulls, arrow sorts the pieces itself,
+            # nulls first like the polars sort in execute()
+            if sum(piece.column(self.key).null_count for piece in pieces) > 0:
+                order = compute.sort_indices(pa.Table.from_batches(pieces), sort_keys = [(self.key, "ascending")], null_placement = "at_start")
+            elif keys.dtype.kind in "iuMm":
+                # fixed width integer-like keys go through the compiled heap merge, O(n log k) with no python per row.
+                # datetimes and durations compare the same as their int64 view.
+                if keys.dtype.kind in "Mm":
+                    keys = keys.view(np.int64)
+                starts = np.zeros(len(piece_keys) + 1, dtype = np.int64)
+                np.cumsum([len(piece) for piece in piece_keys], out = starts[1:])
+                order = np.empty(len(keys), dtype = np.int64)
+                merge_sorted_runs(keys, starts, order)
+            else:
+                # each piece is sorted, so a stable argsort (timsort) over their concatenated keys is a run merge,
+                # O(n log k) rather than a full sort
+                order = np.argsort(keys, kind = "stable")
+            # the take gathers straight out of the mapped pieces into fresh arrow columns, which go downstream as is
+            result = pa.Table.from_batches(pieces).take(order)
+
+            for k in range(0, len(result), self.output_batch_rows):
+                yield result.slice(k, self.output_batch_rows)
+
+        self.sources = None
             
 
 #table = polars.read_parquet("/home/ziheng/tpc-h/lineitem.parquet")
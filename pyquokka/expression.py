@@ -7,19 +7,30 @@ class Expression:
         # the sqlglot_expr here is not a sqlglot.exp but rather a sqlglot.dataframe.sql.column.Column, to make programming easier
         # you can get the corresponding sqlglot.exp by calling the expression attribute
         self.sqlglot_expr = sqlglot_expr
+        # expressions are never mutated after construction, so the rendered sql and the column set are computed once
+        self._sql = None
+        self._required_columns = None
 
     def sql(self) -> str:
+        if self._sql is not None:
+            return self._sql
+
         def dfs(node):
             for k, v in node.iter_expressions():
                 dfs(v)
             if isinstance(node, sqlglot.exp.Binary):
                 node.replace(sqlglot.exp.Paren(this = node.copy()))
         
+        # the paren wrapping rewrites the tree in place, doing it once also keeps repeated calls from nesting parens
         dfs(self.sqlglot_expr.expression)
-        return self.sqlglot_expr.expression.sql(dialect = "duckdb")
+        self._sql = self.sqlglot_expr.expression.sql(dialect = "duckdb")
+        return self._sql
     
     def required_columns(self) -> set:
-        return sql_utils.required_columns_from_exp(self.sqlglot_expr.expression)
+        if self._required_columns is None:
+            self._required_columns = frozenset(sql_utils.required_columns_from_exp(self.sqlglot_expr.expression))
+        # callers are free to mutate what they get back
+        return set(self._required_columns)
 
     def __repr__(self):
         return "Expression({})".format(self.sql())
@@ -185,6 +196,12 @@ class Expression:
     def dt(self):
         return ExprDateTimeNameSpace(self)
     
+REGEX_METACHARACTERS = set(".^$*+?()[]{}|\\")
+
+def string_function(name, column, s):
+    # duckdb's contains / starts_with / ends_with compare against a literal needle, no pattern matching
+    return sqlglot.dataframe.sql.Column(sqlglot.exp.Anonymous(this = name, expressions = [column.expression, sqlglot.exp.Literal.string(s)]))
+
 class ExprStringNameSpace:
     def __init__(self, Expression) -> None:
         self.expr = Expression
@@ -215,7 +232,11 @@ class ExprStringNameSpace:
         """
 
         assert type(s) == str
-        return Expression(self.expr.sqlglot_expr.like("*{}*".format(s)))
+        # a plain needle goes to duckdb's native substring search instead of the generic LIKE matcher.
+        # like polars, anything with regex metacharacters is treated as a pattern.
+        if any(c in REGEX_METACHARACTERS for c in s):
+            return Expression(sqlglot.dataframe.sql.Column(sqlglot.exp.RegexpLike(this = self.expr.sqlglot_expr.expression, expression = sqlglot.exp.Literal.string(s))))
+        return Expression(string_function("contains", self.expr.sqlglot_expr, s))
     
     def starts_with(self, s):
 
@@ -227,7 +248,7 @@ class ExprStringNameSpace:
         """
 
         assert type(s) == str
-        return Expression(self.expr.sqlglot_expr.like("{}*".format(s)))
+        return Expression(string_function("starts_with", self.expr.sqlglot_expr, s))
     
     def ends_with(self, s):
 
@@ -239,7 +260,7 @@ class ExprStringNameSpace:
         """
 
         assert type(s) == str
-        return Expression(self.expr.sqlglot_expr.like("*{}".format(s)))
+        return Expression(string_function("ends_with", self.expr.sqlglot_expr, s))
     
     def length(self):
 
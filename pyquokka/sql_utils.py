@@ -209,6 +209,17 @@ def evaluate(node):
             return from_date.dt.month()
         elif feature == 'day':
             return from_date.dt.day()
+    elif type(node) == sqlglot.expressions.Anonymous and node.name.lower() in {"contains", "starts_with", "ends_with"}:
+        # literal needle string functions, see ExprStringNameSpace
+        arg, needle = node.expressions
+        assert needle.is_string, "needle must be a string"
+        name = node.name.lower()
+        if name == "contains":
+            return evaluate(arg).str.contains(needle.this, literal = True)
+        elif name == "starts_with":
+            return evaluate(arg).str.starts_with(needle.this)
+        else:
+            return evaluate(arg).str.ends_with(needle.this)
     elif type(node) == sqlglot.expressions.RegexpLike:
         assert node.expression.is_string, "regex must be string"
         return evaluate(node.this).str.contains(node.expression.this)
@@ -1,19 +1,55 @@
 import os
 import time
 import boto3
-import subprocess
 import multiprocessing
 import pyquokka
 import ray
 import json
 import signal
+import functools
+import socket
+import errno
+import tempfile
 import polars
-from pssh.clients import ParallelSSHClient
-
-def preexec_function():
-    # Ignore the SIGINT signal by setting the handler to the standard
-    # signal handler SIG_IGN.
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+from concurrent.futures import ThreadPoolExecutor
+from pssh.clients.native import ParallelSSHClient
+from gevent import joinall
+
+# everything the cluster setup ships or runs lives next to the package
+PYQUOKKA_DIR = os.path.dirname(pyquokka.__file__) + os.sep
+COMMON_STARTUP = PYQUOKKA_DIR + "common_startup.sh"
+LEADER_STARTUP = PYQUOKKA_DIR + "leader_startup.sh"
+LEADER_START_RAY = PYQUOKKA_DIR + "leader_start_ray.sh"
+FLIGHT_PY = PYQUOKKA_DIR + "flight.py"
+REDIS_CONF = PYQUOKKA_DIR + "redis.conf"
+
+# instance type -> vcpus. these never change, no need to ask ec2 twice in a process
+VCPU_CACHE = {}
+
+def spawn_server(args):
+    # posix_spawn instead of Popen with a preexec_fn, which forces a full fork of this (possibly very large) process.
+    # SIGINT is blocked in the child so a ctrl-c in the driver doesn't take the servers down with it.
+    return os.posix_spawnp(args[0], args, os.environ, setsigmask = [signal.SIGINT])
+
+def kill_server(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+def port_in_use(port):
+    # try to take the port the way the flight server / redis will, no need to shell out to lsof for this.
+    # they bind with SO_REUSEADDR, so a port left in TIME_WAIT by a previous cluster is free for them and for us.
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind(("0.0.0.0", port))
+    except OSError as e:
+        return e.errno == errno.EADDRINUSE
+    finally:
+        s.close()
+    return False
 
 class EC2Cluster:
     def __init__(self, public_ips, private_ips, instance_ids, cpu_count_per_instance, spill_dir) -> None:
@@ -38,10 +74,9 @@ class EC2Cluster:
         self.leader_public_ip = self.public_ips[0]
         self.leader_private_ip = self.private_ips[0]
         print("EC2 Cluster leader public IP", self.leader_public_ip, "private IP", self.leader_private_ip)
-        pyquokka_loc = pyquokka.__file__.replace("__init__.py","")
         # connect to that ray cluster
         ray.init(address='ray://' + str(self.leader_public_ip) + ':10001', 
-                 runtime_env={"py_modules":[pyquokka_loc]})
+                 runtime_env={"py_modules":[PYQUOKKA_DIR]})
     
     def to_json(self, output = "cluster.json"):
 
@@ -69,7 +104,12 @@ class EC2Cluster:
         
         """
 
-        json.dump({"instance_ids":self.instance_ids,"cpu_count_per_instance":self.cpu_count, "spill_dir": self.spill_dir},open(output,"w"))
+        # write to a temp file and rename over the target, a crash halfway never leaves a truncated cluster file behind
+        payload = json.dumps({"instance_ids":self.instance_ids,"cpu_count_per_instance":self.cpu_count, "spill_dir": self.spill_dir}, separators = (",", ":")).encode()
+        tmp = output + ".tmp"
+        with open(tmp, "wb", buffering = 0) as f:
+            f.write(payload)
+        os.replace(tmp, output)
 
 
 class LocalCluster:
@@ -99,38 +139,34 @@ class LocalCluster:
         print("Initializing local Quokka cluster.")
         self.num_node = 1
         self.cpu_count = multiprocessing.cpu_count()
-        pyquokka_loc = pyquokka.__file__.replace("__init__.py","")
         # we assume you have pyquokka installed, and we are going to spin up a ray cluster locally
         ray.init(ignore_reinit_error=True)
-        flight_file = pyquokka_loc + "/flight.py"
-        self.flight_process = None
-        self.redis_process = None
+        self.flight_pid = None
+        self.redis_pid = None
         os.system("export GLIBC_TUNABLES=glibc.malloc.trim_threshold=524288")
-        port5005 = os.popen("lsof -i:5005").read()
-        if "python" in port5005:
-            raise Exception("Port 5005 is already in use. Kill the process that is using it first.")
+        for port in (5005, 6800):
+            if port_in_use(port):
+                raise Exception("Port {} is already in use. Kill the process that is using it first.".format(port))
             
         try:
-            self.flight_process = subprocess.Popen(["python3", flight_file], preexec_fn = preexec_function)
+            self.flight_pid = spawn_server(["python3", FLIGHT_PY])
         except:
             raise Exception("Could not start flight server properly. Check if there is already something using port 5005, kill it if necessary. Use lsof -i:5005")
-        self.redis_process = subprocess.Popen(["redis-server" , pyquokka_loc + "redis.conf", "--port 6800", "--protected-mode no"], preexec_fn=preexec_function)
+        self.redis_pid = spawn_server(["redis-server" , REDIS_CONF, "--port 6800", "--protected-mode no"])
         self.leader_public_ip = "localhost"
-        self.leader_private_ip = ray.get_runtime_context().gcs_address.split(":")[0]
+        gcs_ip = ray.get_runtime_context().gcs_address.split(":", 1)[0]
+        self.leader_private_ip = gcs_ip
         self.public_ips = {0:"localhost"}
-        self.private_ips = {0: ray.get_runtime_context().gcs_address.split(":")[0]}
+        self.private_ips = {0: gcs_ip}
         print("Finished setting up local Quokka cluster.")
     
     def __del__(self):
         # we need to join the process that is running the flight server! 
-        if self.flight_process is not None:
-            self.flight_process.kill()
-        if self.redis_process is not None:
-            self.redis_process.kill()
-
+        if self.flight_pid is not None:
+            kill_server(self.flight_pid)
+        if self.redis_pid is not None:
+            kill_server(self.redis_pid)
 
-def execute_script(key_location, x):
-    return os.system("ssh -oStrictHostKeyChecking=no -i {} ubuntu@{} 'bash -s' < {}".format(key_location, x, pyquokka.__file__.replace("__init__.py", "common_startup.sh")))
 
 class QuokkaClusterManager:
 
@@ -166,37 +202,83 @@ class QuokkaClusterManager:
         self.key_name = key_name
         self.key_location = key_location
         self.security_group = security_group
+        # authenticated ssh sessions, keyed by the tuple of ips they talk to. setting up a cluster runs a lot of
+        # commands against the same hosts, no point reconnecting for every one.
+        self.ssh_clients = {}
+
+    @functools.cached_property
+    def ec2(self):
+        # building a boto3 client loads the whole service model, make one per manager
+        return boto3.client("ec2")
+
+    def vcpu_count(self, instance_type):
+        if instance_type not in VCPU_CACHE:
+            VCPU_CACHE[instance_type] = self.ec2.describe_instance_types(InstanceTypes=[instance_type])['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus']
+        return VCPU_CACHE[instance_type]
 
     def str_key_to_int(self, d):
         return {int(i):d[i] for i in d}
+
+    def _flatten_instances(self, resp, instance_ids = None):
+        # the instances of a describe_instances response as one flat list. if instance_ids is given the list follows
+        # that order, so the ips line up with the ids and instance 0 stays the leader.
+        instances = [instance for reservation in resp['Reservations'] for instance in reservation['Instances']]
+        if instance_ids is not None:
+            by_id = {instance['InstanceId']: instance for instance in instances}
+            instances = [by_id[instance_id] for instance_id in instance_ids]
+        return instances
+
+    def _describe_filtered(self, ec2, filters):
+        # every instance matching the filters, across however many pages ec2 splits them into
+        return [instance for page in ec2.get_paginator('describe_instances').paginate(Filters = filters) for instance in self._flatten_instances(page)]
     
     def install_python_package(self, cluster, req):
         assert type(cluster) == EC2Cluster
         self.launch_all("pip3 install " + req, list(cluster.public_ips.values()), "Failed to install " + req)
 
+    def get_ssh_client(self, ips):
+        key = tuple(ips)
+        if key not in self.ssh_clients:
+            self.ssh_clients[key] = ParallelSSHClient(list(ips), user="ubuntu", pkey=self.key_location, timeout=5)
+        return self.ssh_clients[key]
+
     def launch_all(self, command, ips, error = "Error", ignore_error = False):
 
-        client = ParallelSSHClient(ips, user="ubuntu", pkey=self.key_location, timeout=5)
+        client = self.get_ssh_client(ips)
         output = client.run_command(command)
+        # wait for every host to finish so the exit codes are filled in, the output stays buffered for reading below
+        client.join(output)
         result = []
         for host_output in output:
             for line in host_output.stdout:
                 result.append(line)
             exit_code = host_output.exit_code
-            assert exit_code == 0 or ignore_error, exit_code
+            assert exit_code == 0 or ignore_error, "{} on {}, exit code {}".format(error, host_output.host, exit_code)
         return result
 
     def copy_all(self, file_path, ips, error = "Error"):
-        commands = ["scp -oStrictHostKeyChecking=no -oConnectTimeout=2 -i " + self.key_location + " " + file_path + " ubuntu@" + str(ip) + ":. " for ip in ips]
-        processes = [subprocess.Popen(command, close_fds=True, shell=True) for command in commands]
-        return_codes = [process.wait() for process in processes]
-        if sum(return_codes) != 0:
-            raise Exception(error)
+        # sftp over the cached ssh sessions instead of an scp process (and a fresh handshake) per host.
+        # relative remote paths land in the home directory, same place scp put them.
+        client = self.get_ssh_client(ips)
+        greenlets = client.copy_file(file_path, os.path.basename(file_path))
+        try:
+            joinall(greenlets, raise_error=True)
+        except Exception as e:
+            raise Exception(error) from e
+
+    def run_scripts(self, script_paths, ip, error = "Error"):
+        # ship packaged scripts to one host and run them there in order, in one ssh command over the cached session.
+        # a script only runs if the ones before it succeeded, a non zero exit raises.
+        for script_path in script_paths:
+            self.copy_all(script_path, [ip], "Failed to copy " + os.path.basename(script_path))
+        self.launch_all(" && ".join("bash " + os.path.basename(script_path) for script_path in script_paths), [ip], error)
 
     def check_instance_alive(self, public_ips):
         count = 0
         while True:
-            z = [os.system("ssh -oStrictHostKeyChecking=no -oConnectTimeout=2 -i " + self.key_location + " ubuntu@" + public_ip +" time") for public_ip in public_ips]
+            # probe every host at once, a round costs the slowest handshake instead of the sum of them
+            with ThreadPoolExecutor(max_workers = len(public_ips)) as pool:
+                z = list(pool.map(lambda public_ip: os.system("ssh -oStrictHostKeyChecking=no -oConnectTimeout=2 -i " + self.key_location + " ubuntu@" + public_ip + " true"), public_ips))
             if sum(z) == 0:
                 break
             else:
@@ -206,12 +288,12 @@ class QuokkaClusterManager:
                 time.sleep(5)
     
     def _initialize_instances(self, instance_ids, spill_dir):
-        ec2 = boto3.client("ec2")
+        ec2 = self.ec2
         waiter = ec2.get_waiter('instance_running')
         waiter.wait(InstanceIds=instance_ids)
-        a = ec2.describe_instances(InstanceIds = instance_ids)
-        public_ips = [k['PublicIpAddress'] for reservation in a['Reservations'] for k in reservation['Instances']] 
-        private_ips = [k['PrivateIpAddress'] for reservation in a['Reservations'] for k in reservation['Instances']] 
+        instances = self._flatten_instances(ec2.describe_instances(InstanceIds = instance_ids), instance_ids)
+        public_ips = [instance['PublicIpAddress'] for instance in instances]
+        private_ips = [instance['PrivateIpAddress'] for instance in instances]
         
         leader_public_ip = public_ips[0]
         leader_private_ip = private_ips[0]
@@ -219,37 +301,45 @@ class QuokkaClusterManager:
         self.check_instance_alive(public_ips)
 
         self.set_up_spill_dir(public_ips, spill_dir)
-        z = os.system("ssh -oStrictHostKeyChecking=no -i " + self.key_location + " ubuntu@" + leader_public_ip + " 'bash -s' < " + pyquokka.__file__.replace("__init__.py","leader_startup.sh"))
-        print(z)
-        z = os.system("ssh -oStrictHostKeyChecking=no -i " + self.key_location + " ubuntu@" + leader_public_ip + " 'bash -s' < " + pyquokka.__file__.replace("__init__.py","leader_start_ray.sh"))
-        print(z)
+        self.run_scripts([LEADER_STARTUP, LEADER_START_RAY], leader_public_ip, "failed to start the leader node")
 
         command ="/home/ubuntu/.local/bin/ray start --address='" + str(leader_private_ip) + ":6380' --redis-password='5241590000000000'"
         self.launch_all(command, public_ips, "ray workers failed to connect to ray head node")
 
         self.copy_and_launch_flight(public_ips)
+        # ordered like instance_ids, callers can build the cluster from these without asking ec2 again
+        return public_ips, private_ips
 
     def set_up_envs(self, public_ips, requirements, aws_access_key, aws_access_id):
             
-        import multiprocessing
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())        
-        pool.starmap(execute_script, [(self.key_location, public_ip) for public_ip in public_ips])
-
-        self.launch_all("aws configure set aws_secret_access_key " + str(aws_access_key), public_ips, "Failed to set AWS access key")
-        self.launch_all("aws configure set aws_access_key_id " + str(aws_access_id), public_ips, "Failed to set AWS access id")
+        # ship the startup script and run it everywhere over the cached ssh sessions, no local ssh process per host.
+        # its exit status was never checked, the apt steps are allowed to fail.
+        self.copy_all(COMMON_STARTUP, public_ips, "Failed to copy startup script.")
+        self.launch_all("bash " + os.path.basename(COMMON_STARTUP), public_ips, "Failed to run startup script", ignore_error = True)
 
         # cluster must have same ray version as client.
         requirements = ["ray==" + ray.__version__, "polars==" + polars.__version__,  "pyquokka"] + requirements
-        for req in requirements:
-            assert type(req) == str
-            try:
-                self.launch_all("pip3 install " + req, public_ips, "Failed to install " + req)
-            except:
-                pass
+        assert all(type(req) == str for req in requirements)
+        # the remote copy keeps the file's name, so write it into a scratch dir rather than a randomly named temp file
+        with tempfile.TemporaryDirectory() as req_dir:
+            req_file = os.path.join(req_dir, "quokka_requirements.txt")
+            with open(req_file, "w") as f:
+                f.write("\n".join(requirements) + "\n")
+            self.copy_all(req_file, public_ips, "Failed to copy requirements file.")
+
+        self.launch_all("aws configure set aws_secret_access_key " + str(aws_access_key) + \
+            " && aws configure set aws_access_key_id " + str(aws_access_id), public_ips, "Failed to set up AWS credentials")
+
+        # one ssh round for all the packages instead of one per package. a bad requirement shouldn't stop the rest from
+        # installing, so if the resolver gives up on the file go one package at a time. xargs still exits non zero if
+        # any of those installs failed, and that fails the launch. take wheels over sdists so nothing gets compiled on
+        # the instances, and the pip cache is dead weight there.
+        self.launch_all("pip3 install --prefer-binary --no-cache-dir -r quokka_requirements.txt" + \
+            " || xargs -n 1 pip3 install --prefer-binary --no-cache-dir < quokka_requirements.txt", public_ips, "Failed to install requirements")
 
     def copy_and_launch_flight(self, public_ips):
         
-        self.copy_all(pyquokka.__file__.replace("__init__.py","flight.py"), public_ips, "Failed to copy flight server file.")
+        self.copy_all(FLIGHT_PY, public_ips, "Failed to copy flight server file.")
         self.launch_all("export GLIBC_TUNABLES=glibc.malloc.trim_threshold=524288", public_ips, "Failed to set malloc limit")
         self.launch_all("nohup python3 -u flight.py > foo.out 2> foo.err < /dev/null &", public_ips, "Failed to start flight servers on workers.")
 
@@ -264,12 +354,10 @@ class QuokkaClusterManager:
         device = devices[0]
         print("Found nvme device: ", device)
         
-        try:
-            self.launch_all("sudo mkfs.ext4 -F -E nodiscard {};".format(device), public_ips, "failed to format nvme ssd")
-            self.launch_all("sudo mount {} {};".format(device, spill_dir), public_ips, "failed to mount nvme ssd")
-            self.launch_all("sudo chmod -R a+rw {}".format(spill_dir), public_ips, "failed to give spill dir permissions")
-        except:
-            pass
+        # one round for format, mount and permissions. if the dir is already mounted (cluster brought up again) leave
+        # it alone instead of reformatting the drive under it.
+        script = "mountpoint -q {1} || (sudo mkfs.ext4 -F -E nodiscard {0} && sudo mount {0} {1} && sudo chmod -R a+rw {1})".format(device, spill_dir)
+        self.launch_all(script, public_ips, "failed to set up spill dir", ignore_error = True)
 
     def create_cluster(self, aws_access_key, aws_access_id, num_instances, instance_type = "i3.2xlarge", ami="ami-0530ca8899fac469f", requirements = [], spill_dir = "/data"):
 
@@ -301,15 +389,19 @@ class QuokkaClusterManager:
         """
 
         start_time = time.time()
-        ec2 = boto3.client("ec2")
-        vcpu_per_node = ec2.describe_instance_types(InstanceTypes=[instance_type])['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus']
+        ec2 = self.ec2
+        # the instance type lookup doesn't depend on the launch, overlap the two round trips
+        with ThreadPoolExecutor(max_workers = 2) as pool:
+            vcpu_future = pool.submit(self.vcpu_count, instance_type)
+            run_future = pool.submit(ec2.run_instances, ImageId=ami, InstanceType = instance_type, SecurityGroupIds = [self.security_group], KeyName=self.key_name ,MaxCount=num_instances, MinCount=num_instances)
+            vcpu_per_node = vcpu_future.result()
+            res = run_future.result()
         waiter = ec2.get_waiter('instance_running')
-        res = ec2.run_instances(ImageId=ami, InstanceType = instance_type, SecurityGroupIds = [self.security_group], KeyName=self.key_name ,MaxCount=num_instances, MinCount=num_instances)
         instance_ids = [res['Instances'][i]['InstanceId'] for i in range(num_instances)] 
         waiter.wait(InstanceIds=instance_ids)
-        a = ec2.describe_instances(InstanceIds = instance_ids)
-        public_ips = [a['Reservations'][0]['Instances'][i]['PublicIpAddress'] for i in range(num_instances)]
-        private_ips = [a['Reservations'][0]['Instances'][i]['PrivateIpAddress'] for i in range(num_instances)]
+        instances = self._flatten_instances(ec2.describe_instances(InstanceIds = instance_ids), instance_ids)
+        public_ips = [instance['PublicIpAddress'] for instance in instances]
+        private_ips = [instance['PrivateIpAddress'] for instance in instances]
 
         self.check_instance_alive(public_ips)
 
@@ -343,17 +435,10 @@ class QuokkaClusterManager:
         
         """
 
-        ec2 = boto3.client("ec2")
+        ec2 = self.ec2
         instance_ids = list(quokka_cluster.instance_ids.values())
         ec2.stop_instances(InstanceIds = instance_ids)
-        while True:
-            time.sleep(0.1)
-            a = ec2.describe_instances(InstanceIds = instance_ids)
-            states = [a['Reservations'][0]['Instances'][i]['State']['Name'] for i in range(len(instance_ids))]
-            if "running" in states:
-                continue
-            else:
-                break
+        ec2.get_waiter('instance_stopped').wait(InstanceIds = instance_ids, WaiterConfig = {'Delay': 5, 'MaxAttempts': 60})
         quokka_cluster.state = "stopped"
         
         
@@ -377,17 +462,10 @@ class QuokkaClusterManager:
 
         """
 
-        ec2 = boto3.client("ec2")
+        ec2 = self.ec2
         instance_ids = list(quokka_cluster.instance_ids.values())
         ec2.terminate_instances(InstanceIds = instance_ids)
-        while True:
-            time.sleep(0.1)
-            a = ec2.describe_instances(InstanceIds = instance_ids)
-            states = [a['Reservations'][0]['Instances'][i]['State']['Name'] for i in range(len(instance_ids))]
-            if "running" in states:
-                continue
-            else:
-                break
+        ec2.get_waiter('instance_terminated').wait(InstanceIds = instance_ids, WaiterConfig = {'Delay': 5, 'MaxAttempts': 60})
         del quokka_cluster
 
     
@@ -416,29 +494,25 @@ class QuokkaClusterManager:
         
         """
         
-        ec2 = boto3.client("ec2")
+        ec2 = self.ec2
         
-        stuff = json.load(open(json_file,"r"))
+        with open(json_file,"r") as f:
+            stuff = json.load(f)
         cpu_count = int(stuff["cpu_count_per_instance"])
         spill_dir = stuff["spill_dir"]
         instance_ids = self.str_key_to_int(stuff["instance_ids"])
         instance_ids = [instance_ids[i] for i in range(len(instance_ids))]
-        a = ec2.describe_instances(InstanceIds = instance_ids)
+        instances = self._flatten_instances(ec2.describe_instances(InstanceIds = instance_ids), instance_ids)
         
-        states = [k['State']['Name'] for reservation in a['Reservations'] for k in reservation['Instances']] 
+        states = [instance['State']['Name'] for instance in instances]
 
         if sum([i=="stopped" for i in states]) == len(states):
             ec2.start_instances(InstanceIds = instance_ids)
-            self._initialize_instances(instance_ids, spill_dir)
-            a = ec2.describe_instances(InstanceIds = instance_ids)
-
-            public_ips = [k['PublicIpAddress'] for reservation in a['Reservations'] for k in reservation['Instances']] 
-            private_ips = [k['PrivateIpAddress'] for reservation in a['Reservations'] for k in reservation['Instances']] 
-
+            public_ips, private_ips = self._initialize_instances(instance_ids, spill_dir)
             return EC2Cluster(public_ips, private_ips, instance_ids, cpu_count, spill_dir)
         if sum([i=="running" for i in states]) == len(states):
-            public_ips = [k['PublicIpAddress'] for reservation in a['Reservations'] for k in reservation['Instances']] 
-            private_ips = [k['PrivateIpAddress'] for reservation in a['Reservations'] for k in reservation['Instances']] 
+            public_ips = [instance['PublicIpAddress'] for instance in instances]
+            private_ips = [instance['PrivateIpAddress'] for instance in instances]
             return EC2Cluster(public_ips, private_ips, instance_ids, cpu_count, spill_dir)
         else:
             print("Cluster in an inconsistent state. Either only some machines are running or some machines have been terminated.")
@@ -482,7 +556,7 @@ class QuokkaClusterManager:
         """
 
         import yaml
-        ec2 = boto3.client("ec2")
+        ec2 = self.ec2
         with open(path_to_yaml, 'r') as f:
             config = yaml.safe_load(f)
         
@@ -491,30 +565,21 @@ class QuokkaClusterManager:
         if cluster_name is None:
             cluster_name = config['cluster_name']
         instance_type = config["available_node_types"]['ray.worker.default']["node_config"]["InstanceType"]
-        cpu_count = ec2.describe_instance_types(InstanceTypes=[instance_type])['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus']
+        cpu_count = self.vcpu_count(instance_type)
 
         filters = [{'Name': 'instance-state-name', 'Values': ['running']},
                    {'Name': f'tag:{tag_key}', 'Values': [cluster_name]}]
-        response = ec2.describe_instances(Filters=filters)
-        instance_ids = []
-        public_ips = []
-        private_ips = []
-
-        instance_names = [[k for k in instance['Tags'] if k['Key'] == 'ray-user-node-type'][0]['Value'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-        instance_ids = [instance['InstanceId'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-        public_ips = [instance['PublicIpAddress'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-        private_ips = [instance['PrivateIpAddress'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-
-        try:
-            head_index = instance_names.index("ray.head.default")
-        except:
+        # let ec2 split head from workers, the head comes back first without scanning tags or rotating lists
+        head_instances = self._describe_filtered(ec2, filters + [{'Name': 'tag:ray-user-node-type', 'Values': ['ray.head.default']}])
+        if len(head_instances) == 0:
             print("No head node found. Please make sure that the cluster is running.")
             return False
-    
-        # rotate instance_ids, public_ips, private_ips so that head is first
-        instance_ids = instance_ids[head_index:] + instance_ids[:head_index]
-        public_ips = public_ips[head_index:] + public_ips[:head_index]
-        private_ips = private_ips[head_index:] + private_ips[:head_index]
+        worker_types = [node_type for node_type in config["available_node_types"] if node_type != "ray.head.default"]
+        worker_instances = self._describe_filtered(ec2, filters + [{'Name': 'tag:ray-user-node-type', 'Values': worker_types}])
+        instances = head_instances + worker_instances
+        instance_ids = [instance['InstanceId'] for instance in instances]
+        public_ips = [instance['PublicIpAddress'] for instance in instances]
+        private_ips = [instance['PrivateIpAddress'] for instance in instances]
 
         assert len(instance_ids) == len(public_ips) == len(private_ips)
         print("Detected {} instances in running ray cluster {}".format(len(instance_ids), cluster_name))
@@ -524,8 +589,7 @@ class QuokkaClusterManager:
         self.launch_all("sudo mkdir {}".format(spill_dir), public_ips, "failed to make temp spill directory", ignore_error = True)
         self.set_up_spill_dir(public_ips, spill_dir)
 
-        z = os.system("ssh -oStrictHostKeyChecking=no -i " + self.key_location + " ubuntu@" + public_ips[0] + " 'bash -s' < " + pyquokka.__file__.replace("__init__.py","leader_startup.sh"))
-        print(z)
+        self.run_scripts([LEADER_STARTUP], public_ips[0], "leader startup script failed")
 
         self.copy_and_launch_flight(public_ips)
         return EC2Cluster(public_ips, private_ips, instance_ids, cpu_count, spill_dir)
@@ -537,7 +601,7 @@ class QuokkaClusterManager:
         """
 
         import yaml
-        ec2 = boto3.client("ec2")
+        ec2 = self.ec2
         with open(path_to_yaml, 'r') as f:
             config = yaml.safe_load(f)
     
@@ -545,27 +609,21 @@ class QuokkaClusterManager:
         if cluster_name is None:
             cluster_name = config['cluster_name']
         instance_type = config["available_node_types"]['ray.worker.default']["node_config"]["InstanceType"]
-        cpu_count = ec2.describe_instance_types(InstanceTypes=[instance_type])['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus']
+        cpu_count = self.vcpu_count(instance_type)
 
         filters = [{'Name': 'instance-state-name', 'Values': ['running']},
                    {'Name': f'tag:{tag_key}', 'Values': [cluster_name]}]
-        response = ec2.describe_instances(Filters=filters)
-
-        instance_names = [[k for k in instance['Tags'] if k['Key'] == 'ray-user-node-type'][0]['Value'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-        instance_ids = [instance['InstanceId'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-        public_ips = [instance['PublicIpAddress'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-        private_ips = [instance['PrivateIpAddress'] for reservation in response['Reservations'] for instance in reservation['Instances']]
-
-        try:
-            head_index = instance_names.index("ray.head.default")
-        except:
+        # let ec2 split head from workers, the head comes back first without scanning tags or rotating lists
+        head_instances = self._describe_filtered(ec2, filters + [{'Name': 'tag:ray-user-node-type', 'Values': ['ray.head.default']}])
+        if len(head_instances) == 0:
             print("No head node found. Please make sure that the cluster is running.")
             return False
-    
-        # rotate instance_ids, public_ips, private_ips so that head is first
-        instance_ids = instance_ids[head_index:] + instance_ids[:head_index]
-        public_ips = public_ips[head_index:] + public_ips[:head_index]
-        private_ips = private_ips[head_index:] + private_ips[:head_index]
+        worker_types = [node_type for node_type in config["available_node_types"] if node_type != "ray.head.default"]
+        worker_instances = self._describe_filtered(ec2, filters + [{'Name': 'tag:ray-user-node-type', 'Values': worker_types}])
+        instances = head_instances + worker_instances
+        instance_ids = [instance['InstanceId'] for instance in instances]
+        public_ips = [instance['PublicIpAddress'] for instance in instances]
+        private_ips = [instance['PrivateIpAddress'] for instance in instances]
 
         assert len(instance_ids) == len(public_ips) == len(private_ips)
         print("Detected {} instances in running ray cluster {}".format(len(instance_ids), cluster_name))
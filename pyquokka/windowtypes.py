@@ -46,6 +46,11 @@ class Window:
         for key, value in self.aggregation_dict.items():
             sql_agg_str += f"{value} OVER win AS {key}, "
         return sql_agg_str[:-2]
+
+    def sql_group_aggregations(self):
+        assert self.aggregation_dict is not None, "aggregation_dict is not set"
+        # same as sql_aggregations, but for a plain GROUP BY instead of a window frame
+        return ", ".join(f"{value} AS {key}" for key, value in self.aggregation_dict.items())
     
     @staticmethod
     def val_to_polars(val):
@@ -21,10 +21,11 @@ setup(
         install_requires=[
             'cffi',
             'pyarrow',
-            'duckdb>=0.6.0',
+            'duckdb>=0.8.0',
             'redis',
             'boto3',
             'numpy',
+            'numba',
             'pandas',
             #'protobuf==3.20.*', uncomment if Ray does not work on Apple
             'protobuf',
@@ -37,7 +38,7 @@ setup(
             'tqdm',
             'aiohttp',
             'botocore',
-            'parallel-ssh'
+            'parallel-ssh>=2.0.0'
             ], # add any additional packages that 
         extra_requires = {
                 "datalake" : ["pyiceberg", "deltalake"]
@@ -0,0 +1,114 @@
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+polars = pytest.importorskip("polars")
+pytest.importorskip("duckdb")
+
+from pyquokka.executors import DistinctExecutor
+
+
+def null_first(values):
+    return sorted(values, key = lambda x: (x is not None, x))
+
+
+def test_distinct_null_keys():
+    exe = DistinctExecutor(["k"])
+    first = exe.execute([pa.table({"k": [1, None, 1, None, 2]})], 0, 0)
+    second = exe.execute([pa.table({"k": [None, 2, 3, None]})], 0, 0)
+
+    assert null_first(first["k"].to_list()) == [None, 1, 2]
+    assert second["k"].to_list() == [3]
+
+
+def test_distinct_repeated_batches():
+    exe = DistinctExecutor(["a", "b"])
+    batch = pa.table({"a": [1, 1, None, None, 2], "b": ["x", None, "x", None, ""], "v": [1.0, 2.0, 3.0, 4.0, 5.0]})
+    first = exe.execute([batch], 0, 0)
+    assert first.columns == ["a", "b", "v"]
+    assert len(first) == 5
+
+    # the same rows again contribute nothing, keys that only differ from seen ones by a null are new
+    assert len(exe.execute([batch], 0, 0)) == 0
+    third = exe.execute([batch, pa.table({"a": [2, None], "b": [None, ""], "v": [6.0, 7.0]})], 0, 0)
+    assert sorted(zip(third["a"].to_list(), third["b"].to_list()), key = str) == sorted([(2, None), (None, "")], key = str)
+
+
+def run_sort(tmp_path, tables, key, **kwargs):
+    from pyquokka.executors import SuperFastSortExecutor
+    exe = SuperFastSortExecutor(key, data_dir = str(tmp_path), **kwargs)
+    for table in tables:
+        exe.execute([table], 0, 0)
+    return pa.concat_tables(list(exe.done(0)))
+
+
+@pytest.mark.parametrize("keys", [
+    [[3, None, 1, 7], [None, None, 2, 5], [4, 6, None, 0]],
+    [["c", None, "a"], [None, "b", "e"], ["d", None, None]],
+])
+def test_sort_null_keys_across_runs(tmp_path, keys):
+    tables = [pa.table({"k": run, "v": list(range(len(run)))}) for run in keys]
+    result = run_sort(tmp_path, tables, "k", output_batch_rows = 2)
+
+    expected = null_first([k for run in keys for k in run])
+    assert result["k"].to_pylist() == expected
+    assert result.num_rows == sum(len(run) for run in keys)
+
+
+def test_window_executors_accept_sql_only_aggregations():
+    from pyquokka.executors import HoppingWindowExecutor, SlidingWindowExecutor, SessionWindowExecutor
+    from pyquokka.windowtypes import HoppingWindow, SlidingWindow, SessionWindow, OnCompletionTrigger, OnEventTrigger
+
+    # count(*) has no polars translation, it only runs on the duckdb paths
+    aggregations = {"n": "count(*)"}
+    HoppingWindowExecutor("t", "k", HoppingWindow("t", "k", 10, 10, dict(aggregations)), OnCompletionTrigger())
+    SlidingWindowExecutor("t", "k", SlidingWindow("t", "k", 10, dict(aggregations)), OnEventTrigger())
+    SessionWindowExecutor("t", "k", SessionWindow("t", "k", 10, dict(aggregations)), OnEventTrigger())
+
+
+def test_session_window_execute():
+    from pyquokka.executors import SessionWindowExecutor
+    from pyquokka.windowtypes import SessionWindow, OnCompletionTrigger
+
+    exe = SessionWindowExecutor("t", "k", SessionWindow("t", "k", 5, {"total": "sum(x)"}), OnCompletionTrigger())
+    # sessions: a at 0-3, a at 20, b at 1-9, b at 30. only the last session of each key is still open
+    batch = pa.table({"k": ["a", "b", "a", "b", "a", "b", "a", "b"], "t": [0, 1, 3, 5, 20, 9, 21, 30], "x": [1, 2, 3, 4, 5, 6, 7, 8]})
+    result = exe.execute([batch], 0, 0)
+    assert sorted(zip(result["k"].to_list(), result["total"].to_list())) == [("a", 4), ("b", 12)]
+
+    # done flushes the open sessions that were carried over
+    assert exe.done(0)["total"].sum() == 20
+
+
+def test_tumbling_window_matches_groupby_dynamic():
+    from pyquokka.executors import HoppingWindowExecutor
+    from pyquokka.windowtypes import HoppingWindow, OnCompletionTrigger
+
+    exe = HoppingWindowExecutor("t", "k", HoppingWindow("t", "k", 10, 10, {"s": "sum(x)"}), OnCompletionTrigger())
+    batch = polars.DataFrame({"k": ["a"] * 5, "t": [-15, -5, -1, 3, 12], "x": [1, 2, 3, 4, 5]}).with_columns(polars.col("x").cast(polars.Int32))
+    result = exe.tumbling_agg(batch)
+
+    # negative times floor into their window, and the integer sum keeps the input type
+    expected = batch.groupby_dynamic("t", every = "10i", period = "10i", by = "k").agg(polars.col("x").sum().alias("s"))
+    assert result.schema == expected.schema
+    assert result.to_dicts() == expected.to_dicts()
+
+
+def test_distinct_keeps_first_occurrence():
+    exe = DistinctExecutor(["k"])
+    batch = pa.table({"k": [2, 1, 2, None, 1, None], "v": ["a", "b", "c", "d", "e", "f"]})
+    result = exe.execute([batch], 0, 0)
+    assert result["k"].to_list() == [2, 1, None]
+    assert result["v"].to_list() == ["a", "b", "d"]
+
+
+@pytest.mark.parametrize("keys", [
+    [[1, 2], None, [1, 2], [3], []],
+    [{"a": 1, "b": "x"}, None, {"a": 1, "b": "x"}, {"a": 1, "b": None}, {"a": 2, "b": "x"}],
+])
+def test_distinct_nested_keys(keys):
+    exe = DistinctExecutor(["k"])
+    first = exe.execute([pa.table({"k": keys, "v": list(range(len(keys)))})], 0, 0)
+    assert first["v"].to_list() == [0, 1, 3, 4]
+
+    second = exe.execute([pa.table({"k": keys[::-1], "v": list(range(len(keys)))})], 0, 0)
+    assert len(second) == 0